@@ -41,6 +41,7 @@ from freenasUI.middleware.client import client
 RE_MOUNT = re.compile(
     r'^(?P<fs_spec>.+?) on (?P<fs_file>.+?) \((?P<fs_vfstype>\w+)', re.S
 )
+RE_NETBIOS_NAME = re.compile(r"^[a-zA-Z0-9\.\-_!@#\$%^&\(\)'\{\}~]{1,15}$")
 VERSION_FILE = '/etc/version'
 _VERSION = None
 log = logging.getLogger("common.system")
@@ -382,9 +383,7 @@ def get_hostname():
 
 
 def validate_netbios_name(netbiosname):
-    regex = re.compile(r"^[a-zA-Z0-9\.\-_!@#\$%^&\(\)'\{\}~]{1,15}$")
-
-    if not regex.match(netbiosname):
+    if not RE_NETBIOS_NAME.match(netbiosname):
         raise Exception("Invalid NetBIOS name")
 
 
@@ -414,12 +413,13 @@ def compare_netbios_names(netbiosname1, netbiosname2, validate_func=validate_net
     for n1 in netbiosname1_parts:
         if validate_func:
             validate_func(n1)
+        n1 = n1.casefold()
 
         for n2 in netbiosname2_parts:
             if validate_func:
                 validate_func(n2)
 
-            if n1.lower() == n2.lower():
+            if n1 == n2.casefold():
                 return True
 
     return False
@@ -25,14 +25,16 @@
 #####################################################################
 import base64
 import logging
-import os
 import re
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 from ldap import LDAPError
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from django.forms import FileField
+from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 
 from dojango import forms
@@ -49,82 +51,113 @@ from freenasUI.common.system import (
     compare_netbios_names
 )
 from freenasUI.directoryservice import models, utils
+from freenasUI.freeadmin.middleware import request_cache
 from freenasUI.middleware.client import client
 from freenasUI.middleware.exceptions import MiddlewareError
 from freenasUI.middleware.notifier import notifier
 from freenasUI.services.models import CIFS, ServiceMonitor
 
-log = logging.getLogger('directoryservice.form')
-
-
-class idmap_ad_Form(ModelForm):
-    class Meta:
-        fields = '__all__'
-        model = models.idmap_ad
-        exclude = [
-            'idmap_ds_type',
-            'idmap_ds_id'
-        ]
+try:
+    from freenasUI.failover.utils import node_label_field
+except ImportError:
+    # failover is only shipped on TrueNAS
+    node_label_field = None
 
+log = logging.getLogger('directoryservice.form')
 
-class idmap_adex_Form(ModelForm):
-    class Meta:
-        fields = '__all__'
-        model = models.idmap_adex
-        exclude = [
-            'idmap_ds_type',
-            'idmap_ds_id'
-        ]
-
+RE_KEYTAB_PRINCIPAL = re.compile(
+    r'^(\d+)\s+([\w-]+(?:\s+\(\d+\))?)\s+(\S+)\s+([\d+\-]+)$'
+)
 
-class idmap_autorid_Form(ModelForm):
-    class Meta:
-        fields = '__all__'
-        model = models.idmap_autorid
-        exclude = [
-            'idmap_ds_type',
-            'idmap_ds_id'
-        ]
+_IDMAP_EXCLUDE = ('idmap_ds_type', 'idmap_ds_id')
+
+# Fields whose change requires the cached AD configuration to be cleared
+_AD_TRACKED = (
+    'ad_domainname',
+    'ad_allow_trusted_doms',
+    'ad_use_default_domain',
+    'ad_unix_extensions',
+    'ad_verbose_logging',
+    'ad_bindname',
+    'ad_bindpw',
+)
+_CIFS_TRACKED = (
+    'cifs_srv_netbiosname',
+    'cifs_srv_netbiosname_b',
+    'cifs_srv_netbiosalias',
+)
 
 
-class idmap_fruit_Form(ModelForm):
-    class Meta:
-        fields = '__all__'
-        model = models.idmap_fruit
-        exclude = [
-            'idmap_ds_type',
-            'idmap_ds_id'
-        ]
+def _get_cifs():
+    return CIFS.objects.only('id', *_CIFS_TRACKED).latest('id')
+
+
+def _get_cifs_cached():
+    """
+    Return the CIFS settings row, fetching it only once per HTTP request.
+    Only the NetBIOS fields handled by the directory service forms are loaded.
+    """
+    cache = request_cache()
+    if cache is None:
+        return _get_cifs()
+    cifs = cache.get('cifs')
+    if cifs is None:
+        cifs = cache['cifs'] = _get_cifs()
+    return cifs
+
+
+def _parse_host_port(value, port):
+    """
+    Split an optional ":port" suffix off `value`, falling back to `port`.
+    """
+    if not value:
+        return None, port
+    host, sep, suffix = value.rpartition(':')
+    if not sep:
+        return value, port
+    if suffix.isdigit():
+        port = int(suffix)
+    return host, port
+
+
+def _port_probe(host, port):
+    """
+    Returns an error message if nothing is listening on host:port.
+    """
+    errors = []
+    try:
+        ret = FreeNAS_ActiveDirectory.port_is_listening(
+            host=host, port=port, errors=errors
+        )
 
+        if ret is False:
+            raise Exception(
+                'Invalid Host/Port: %s' % errors[0]
+            )
 
-class idmap_hash_Form(ModelForm):
-    class Meta:
-        fields = '__all__'
-        model = models.idmap_hash
-        exclude = [
-            'idmap_ds_type',
-            'idmap_ds_id'
-        ]
+    except Exception as e:
+        return '%s.' % e
 
 
-class idmap_ldap_Form(ModelForm):
-    class Meta:
-        fields = '__all__'
-        model = models.idmap_ldap
-        exclude = [
-            'idmap_ds_type',
-            'idmap_ds_id'
-        ]
+def _make_idmap_form(model):
+    """
+    Build the plain ModelForm used by most idmap backends.
+    """
+    meta = type('Meta', (object,), {
+        'fields': '__all__',
+        'model': model,
+        'exclude': _IDMAP_EXCLUDE,
+    })
+    return type('%s_Form' % model.__name__, (ModelForm,), {'Meta': meta})
 
 
-class idmap_nss_Form(ModelForm):
-    class Meta:
-        fields = '__all__'
-        model = models.idmap_nss
-        exclude = [
-            'idmap_ds_type',
-            'idmap_ds_id'
-        ]
+idmap_ad_Form = _make_idmap_form(models.idmap_ad)
+idmap_adex_Form = _make_idmap_form(models.idmap_adex)
+idmap_autorid_Form = _make_idmap_form(models.idmap_autorid)
+idmap_fruit_Form = _make_idmap_form(models.idmap_fruit)
+idmap_hash_Form = _make_idmap_form(models.idmap_hash)
+idmap_ldap_Form = _make_idmap_form(models.idmap_ldap)
+idmap_nss_Form = _make_idmap_form(models.idmap_nss)
 
 
 class idmap_rfc2307_Form(ModelForm):
@@ -158,10 +191,7 @@ class idmap_rfc2307_Form(ModelForm):
             'idmap_rfc2307_ldap_user_dn_password':
                 forms.widgets.PasswordInput(render_value=False)
         }
-        exclude = [
-            'idmap_ds_type',
-            'idmap_ds_id'
-        ]
+        exclude = _IDMAP_EXCLUDE
 
     def __init__(self, *args, **kwargs):
         super(idmap_rfc2307_Form, self).__init__(*args, **kwargs)
@@ -187,44 +217,10 @@ class idmap_rfc2307_Form(ModelForm):
         return cdata
 
 
-class idmap_rid_Form(ModelForm):
-    class Meta:
-        fields = '__all__'
-        model = models.idmap_rid
-        exclude = [
-            'idmap_ds_type',
-            'idmap_ds_id'
-        ]
-
-
-class idmap_tdb_Form(ModelForm):
-    class Meta:
-        fields = '__all__'
-        model = models.idmap_tdb
-        exclude = [
-            'idmap_ds_type',
-            'idmap_ds_id'
-        ]
-
-
-class idmap_tdb2_Form(ModelForm):
-    class Meta:
-        fields = '__all__'
-        model = models.idmap_tdb2
-        exclude = [
-            'idmap_ds_type',
-            'idmap_ds_id'
-        ]
-
-
-class idmap_script_Form(ModelForm):
-    class Meta:
-        fields = '__all__'
-        model = models.idmap_script
-        exclude = [
-            'idmap_ds_type',
-            'idmap_ds_id'
-        ]
+idmap_rid_Form = _make_idmap_form(models.idmap_rid)
+idmap_tdb_Form = _make_idmap_form(models.idmap_tdb)
+idmap_tdb2_Form = _make_idmap_form(models.idmap_tdb2)
+idmap_script_Form = _make_idmap_form(models.idmap_script)
 
 
 class ActiveDirectoryForm(ModelForm):
@@ -279,53 +275,31 @@ class ActiveDirectoryForm(ModelForm):
         }
 
     def __original_save(self):
-        for name in (
-            'ad_domainname',
-            'ad_allow_trusted_doms',
-            'ad_use_default_domain',
-            'ad_unix_extensions',
-            'ad_verbose_logging',
-            'ad_bindname',
-            'ad_bindpw'
-        ):
-            setattr(
-                self.instance,
-                "_original_%s" % name,
-                getattr(self.instance, name)
-            )
-        for name in (
-            'cifs_srv_netbiosname',
-            'cifs_srv_netbiosname_b',
-            'cifs_srv_netbiosalias',
-        ):
-            setattr(
-                self.cifs,
-                "_original_%s" % name,
-                getattr(self.cifs, name),
-            )
+        self._orig_ad_enable = self.instance.ad_enable
+        self._orig_ad = {
+            name: getattr(self.instance, name) for name in _AD_TRACKED
+        }
+        self._orig_cifs = {
+            name: getattr(self.cifs, name) for name in _CIFS_TRACKED
+        }
 
     def __original_changed(self):
-        if (
-            self.instance._original_ad_domainname != self.instance.ad_domainname or
-            self.cifs._original_cifs_srv_netbiosname != self.cifs.cifs_srv_netbiosname or
-            self.cifs._original_cifs_srv_netbiosname_b != self.cifs.cifs_srv_netbiosname_b or
-            self.cifs._original_cifs_srv_netbiosalias != self.cifs.cifs_srv_netbiosalias or
-            self.instance._original_ad_allow_trusted_doms != self.instance.ad_allow_trusted_doms or
-            self.instance._original_ad_use_default_domain != self.instance.ad_use_default_domain or
-            self.instance._original_ad_unix_extensions != self.instance.ad_unix_extensions or
-            self.instance._original_ad_verbose_logging != self.instance.ad_verbose_logging or
-            self.instance._original_ad_bindname != self.instance.ad_bindname or
-            self.instance._original_ad_bindpw != self.instance.ad_bindpw
-        ):
-            return True
-        return False
+        return any(
+            getattr(self.instance, name) != value
+            for name, value in self._orig_ad.items()
+        ) or any(
+            getattr(self.cifs, name) != value
+            for name, value in self._orig_cifs.items()
+        )
 
     def __init__(self, *args, **kwargs):
         super(ActiveDirectoryForm, self).__init__(*args, **kwargs)
         if self.instance.ad_bindpw:
             self.fields['ad_bindpw'].required = False
-        self.cifs = CIFS.objects.latest('id')
-        self.__original_save()
+        self.cifs = _get_cifs_cached()
+        # Snapshot is only consulted by save(), which requires bound data
+        if self.is_bound:
+            self.__original_save()
 
         self.fields["ad_idmap_backend"].widget.attrs["onChange"] = (
             "activedirectory_idmap_check();"
@@ -338,10 +312,9 @@ class ActiveDirectoryForm(ModelForm):
             self.fields['ad_netbiosname_a'].initial = self.cifs.cifs_srv_netbiosname
             self.fields['ad_netbiosname_b'].initial = self.cifs.cifs_srv_netbiosname_b
             self.fields['ad_netbiosalias'].initial = self.cifs.cifs_srv_netbiosalias
-        _n = notifier()
+        self._n = _n = notifier()
         if not _n.is_freenas():
             if _n.failover_licensed():
-                from freenasUI.failover.utils import node_label_field
                 node_label_field(
                     _n.failover_node(),
                     self.fields['ad_netbiosname_a'],
@@ -352,91 +325,59 @@ class ActiveDirectoryForm(ModelForm):
         else:
                 del self.fields['ad_netbiosname_b']
 
-    def get_dcport(self):
-        ad_dcname = self.cleaned_data.get('ad_dcname')
-        ad_dcport = 389
-
-        ad_ssl = self.cleaned_data.get('ad_ssl')
-        if ad_ssl == 'on':
-            ad_dcport = 636
-
-        if not ad_dcname:
-            return ad_dcport
-
-        parts = ad_dcname.split(':')
-        if len(parts) > 1 and parts[1].isdigit():
-            ad_dcport = int(parts[1])
+    @cached_property
+    def _dc_host_port(self):
+        return _parse_host_port(
+            self.cleaned_data.get('ad_dcname'),
+            636 if self.cleaned_data.get('ad_ssl') == 'on' else 389,
+        )
 
-        return ad_dcport
+    def get_dcport(self):
+        return self._dc_host_port[1]
 
     def clean_ad_dcname(self):
-        ad_dcname = self.cleaned_data.get('ad_dcname')
-        ad_dcport = self.get_dcport()
-
-        if not ad_dcname:
-            return None
-
-        parts = ad_dcname.split(':')
-        ad_dcname = parts[0]
-
-        errors = []
-        try:
-            ret = FreeNAS_ActiveDirectory.port_is_listening(
-                host=ad_dcname, port=ad_dcport, errors=errors
-            )
+        return self.cleaned_data.get('ad_dcname') or None
 
-            if ret is False:
-                raise Exception(
-                    'Invalid Host/Port: %s' % errors[0]
-                )
-
-        except Exception as e:
-            raise forms.ValidationError('%s.' % e)
-
-        return self.cleaned_data.get('ad_dcname')
+    @cached_property
+    def _gc_host_port(self):
+        return _parse_host_port(
+            self.cleaned_data.get('ad_gcname'),
+            3269 if self.cleaned_data.get('ad_ssl') == 'on' else 3268,
+        )
 
     def get_gcport(self):
-        ad_gcname = self.cleaned_data.get('ad_gcname')
-        ad_gcport = 3268
-
-        ad_ssl = self.cleaned_data.get('ad_ssl')
-        if ad_ssl == 'on':
-            ad_gcport = 3269
-
-        if not ad_gcname:
-            return ad_gcport
-
-        parts = ad_gcname.split(':')
-        if len(parts) > 1 and parts[1].isdigit():
-            ad_gcport = int(parts[1])
-
-        return ad_gcport
+        return self._gc_host_port[1]
 
     def clean_ad_gcname(self):
-        ad_gcname = self.cleaned_data.get('ad_gcname')
-        ad_gcport = self.get_gcport()
-
-        if not ad_gcname:
-            return None
-
-        parts = ad_gcname.split(':')
-        ad_gcname = parts[0]
+        return self.cleaned_data.get('ad_gcname') or None
+
+    def _probe_ports(self):
+        """
+        Check that the DC and GC are listening. Both probes can block up
+        to the socket timeout so they are run concurrently.
+        """
+        probes = {}
+        for name, (host, port) in (
+            ('ad_dcname', self._dc_host_port),
+            ('ad_gcname', self._gc_host_port),
+        ):
+            if host:
+                probes[name] = (host, port)
 
-        errors = []
-        try:
-            ret = FreeNAS_ActiveDirectory.port_is_listening(
-                host=ad_gcname, port=ad_gcport, errors=errors
-            )
+        if not probes:
+            return
 
-            if ret is False:
-                raise Exception(
-                    'Invalid Host/Port: %s' % errors[0]
-                )
+        with ThreadPoolExecutor(max_workers=len(probes)) as executor:
+            futures = {
+                name: executor.submit(_port_probe, host, port)
+                for name, (host, port) in probes.items()
+            }
 
-        except Exception as e:
-            raise forms.ValidationError('%s.' % e)
-
-        return self.cleaned_data.get('ad_gcname')
+        for name, future in futures.items():
+            error = future.result()
+            if error:
+                self._errors[name] = self.error_class([error])
+                self.cleaned_data.pop(name, None)
 
     def clean_ad_netbiosname_a(self):
         netbiosname = self.cleaned_data.get("ad_netbiosname_a")
@@ -447,17 +388,9 @@ class ActiveDirectoryForm(ModelForm):
         return netbiosname
 
     def clean_ad_netbiosname_b(self):
-        netbiosname_a = self.cleaned_data.get("ad_netbiosname_a")
         netbiosname = self.cleaned_data.get("ad_netbiosname_b")
         if not netbiosname:
             return netbiosname
-        if netbiosname_a and netbiosname_a == netbiosname:
-            with client as c:
-                system_dataset = c.call('systemdataset.config')
-            if system_dataset['path'] == "freenas-boot":
-                raise forms.ValidationError(_(
-                    'When the system dataset is located on the boot device, the same NetBIOS name cannot be used on both controllers.'
-                ))
         try:
             validate_netbios_name(netbiosname)
         except Exception as e:
@@ -474,6 +407,8 @@ class ActiveDirectoryForm(ModelForm):
         return netbiosalias
 
     def clean(self):
+        self._probe_ports()
+
         cdata = self.cleaned_data
         domain = cdata.get("ad_domainname")
         bindname = cdata.get("ad_bindname")
@@ -487,14 +422,27 @@ class ActiveDirectoryForm(ModelForm):
         ad_kerberos_principal = cdata["ad_kerberos_principal"]
         workgroup = None
 
-        if certificate:
+        # Same NetBIOS name on both controllers requires checking where the
+        # system dataset lives, do it along with the certificate lookup so
+        # only one middleware connection is made.
+        same_netbiosname = bool(netbiosname_b) and netbiosname == netbiosname_b
+        if certificate or same_netbiosname:
             with client as c:
-                certificate = c.call(
-                    'certificateauthority.query',
-                    [['id', '=', certificate.id]],
-                    {'get': True}
-                )
-            certificate = certificate['certificate_path']
+                if same_netbiosname:
+                    system_dataset = c.call('systemdataset.config')
+                if certificate:
+                    certificate = c.call(
+                        'certificateauthority.query',
+                        [['id', '=', certificate.id]],
+                        {'get': True}
+                    )['certificate_path']
+
+            if same_netbiosname and system_dataset['path'] == "freenas-boot":
+                self._errors['ad_netbiosname_b'] = self.error_class([_(
+                    'When the system dataset is located on the boot device, the same NetBIOS name cannot be used on both controllers.'
+                )])
+                cdata.pop('ad_netbiosname_b', None)
+                netbiosname_b = None
 
         args = {
             'domain': domain,
@@ -587,13 +535,14 @@ class ActiveDirectoryForm(ModelForm):
         monit_retry = self.cleaned_data.get("ad_recover_retry")
         fqdn = self.cleaned_data.get("ad_domainname")
         sm = None
+        timeouts = _fs().directoryservice.activedirectory.timeout
 
         if self.__original_changed():
-            notifier().clear_activedirectory_config()
+            self._n.clear_activedirectory_config()
 
-        started = notifier().started(
+        started = self._n.started(
             "activedirectory",
-            timeout=_fs().directoryservice.activedirectory.timeout.started
+            timeout=timeouts.started
         )
         obj = super(ActiveDirectoryForm, self).save()
 
@@ -608,37 +557,37 @@ class ActiveDirectoryForm(ModelForm):
         self.cifs.cifs_srv_netbiosname = self.cleaned_data.get("ad_netbiosname_a")
         self.cifs.cifs_srv_netbiosname_b = self.cleaned_data.get("ad_netbiosname_b")
         self.cifs.cifs_srv_netbiosalias = self.cleaned_data.get("ad_netbiosalias")
-        self.cifs.save()
+        self.cifs.save(update_fields=_CIFS_TRACKED)
 
         if enable:
             if started is True:
-                timeout = _fs().directoryservice.activedirectory.timeout.restart
+                timeout = timeouts.restart
                 try:
-                    started = notifier().restart("activedirectory", timeout=timeout)
+                    started = self._n.restart("activedirectory", timeout=timeout)
                 except Exception as e:
                     raise MiddlewareError(
                         _("Active Directory restart timed out after %d seconds." % timeout),
                     )
 
             if started is False:
-                timeout = _fs().directoryservice.activedirectory.timeout.start
+                timeout = timeouts.start
                 try:
-                    started = notifier().start("activedirectory", timeout=timeout)
+                    started = self._n.start("activedirectory", timeout=timeout)
                 except Exception as e:
                     raise MiddlewareError(
                         _("Active Directory start timed out after %d seconds." % timeout),
                     )
             if started is False:
                 self.instance.ad_enable = False
-                super(ActiveDirectoryForm, self).save()
+                self.instance.save(update_fields=['ad_enable'])
                 raise MiddlewareError(
                     _("Active Directory failed to reload."),
                 )
         else:
             if started is True:
-                timeout = _fs().directoryservice.activedirectory.timeout.stop
+                timeout = timeouts.stop
                 try:
-                    started = notifier().stop("activedirectory", timeout=timeout)
+                    started = self._n.stop("activedirectory", timeout=timeout)
                 except Exception as e:
                     raise MiddlewareError(
                         _("Active Directory stop timed out after %d seconds." % timeout),
@@ -679,35 +628,42 @@ class ActiveDirectoryForm(ModelForm):
                 raise MiddlewareError(
                     _("Unable to create ServiceMonitor: %s" % e),
                 )
+            sm_changed = True
 
         else:
-            sm.sm_name = sm_name
-            if fqdn != sm.sm_host:
-                sm.sm_host = fqdn
-            if dcport != sm.sm_port:
-                sm.sm_port = dcport
-            if monit_frequency != sm.sm_frequency:
-                sm.sm_frequency = monit_frequency
-            if monit_retry != sm.sm_retry:
-                sm.sm_retry = monit_retry
-            if enable_monitoring != sm.sm_enable:
-                sm.sm_enable = enable_monitoring
+            changed = []
+            for name, value in (
+                ('sm_host', fqdn),
+                ('sm_port', dcport),
+                ('sm_frequency', monit_frequency),
+                ('sm_retry', monit_retry),
+                ('sm_enable', enable_monitoring),
+            ):
+                if getattr(sm, name) != value:
+                    setattr(sm, name, value)
+                    changed.append(name)
+
+            if changed:
+                try:
+                    sm.save(update_fields=changed)
+                except Exception as e:
+                    log.debug("XXX: Unable to create ServiceMonitor: %s", e)
+                    raise MiddlewareError(
+                        _("Unable to save ServiceMonitor: %s" % e),
+                    )
+            sm_changed = bool(changed)
 
-            try:
-                sm.save(force_update=True)
-            except Exception as e:
-                log.debug("XXX: Unable to create ServiceMonitor: %s", e)
-                raise MiddlewareError(
-                    _("Unable to save ServiceMonitor: %s" % e),
-                )
+        # Nothing for the service monitor to pick up
+        if not sm_changed and enable == self._orig_ad_enable:
+            return obj
 
+        log.debug(
+            "[ServiceMonitoring] %s %s service, frequency: %d, retry: %d",
+            'Add' if enable_monitoring and enable else 'Remove',
+            'activedirectory', monit_frequency, monit_retry
+        )
         with client as c:
-            if enable_monitoring and enable:
-                log.debug("[ServiceMonitoring] Add %s service, frequency: %d, retry: %d" % ('activedirectory', monit_frequency, monit_retry))
-                c.call('servicemonitor.restart')
-            else:
-                log.debug("[ServiceMonitoring] Remove %s service, frequency: %d, retry: %d" % ('activedirectory', monit_frequency, monit_retry))
-                c.call('servicemonitor.restart')
+            c.call('servicemonitor.restart')
 
         return obj
 
@@ -809,15 +765,14 @@ class LDAPForm(ModelForm):
         self.fields["ldap_enable"].widget.attrs["onChange"] = (
             "ldap_mutex_toggle();"
         )
-        self.cifs = CIFS.objects.latest('id')
+        self.cifs = _get_cifs_cached()
         if self.cifs:
             self.fields['ldap_netbiosname_a'].initial = self.cifs.cifs_srv_netbiosname
             self.fields['ldap_netbiosname_b'].initial = self.cifs.cifs_srv_netbiosname_b
             self.fields['ldap_netbiosalias'].initial = self.cifs.cifs_srv_netbiosalias
-        _n = notifier()
+        self._n = _n = notifier()
         if not _n.is_freenas():
             if _n.failover_licensed():
-                from freenasUI.failover.utils import node_label_field
                 node_label_field(
                     _n.failover_node(),
                     self.fields['ldap_netbiosname_a'],
@@ -969,25 +924,25 @@ class LDAPForm(ModelForm):
     def save(self):
         enable = self.cleaned_data.get("ldap_enable")
 
-        started = notifier().started("ldap")
+        started = self._n.started("ldap")
         obj = super(LDAPForm, self).save()
         self.cifs.cifs_srv_netbiosname = self.cleaned_data.get("ldap_netbiosname_a")
         self.cifs.cifs_srv_netbiosname_b = self.cleaned_data.get("ldap_netbiosname_b")
         self.cifs.cifs_srv_netbiosalias = self.cleaned_data.get("ldap_netbiosalias")
-        self.cifs.save()
+        self.cifs.save(update_fields=_CIFS_TRACKED)
 
         if enable:
             if started is True:
-                started = notifier().restart("ldap", timeout=_fs().directoryservice.ldap.timeout.restart)
+                started = self._n.restart("ldap", timeout=_fs().directoryservice.ldap.timeout.restart)
             if started is False:
-                started = notifier().start("ldap", timeout=_fs().directoryservice.ldap.timeout.start)
+                started = self._n.start("ldap", timeout=_fs().directoryservice.ldap.timeout.start)
             if started is False:
                 self.instance.ldap_enable = False
                 super(LDAPForm, self).save()
                 raise MiddlewareError(_("LDAP failed to reload."))
         else:
             if started is True:
-                started = notifier().stop("ldap", timeout=_fs().directoryservice.ldap.timeout.stop)
+                started = self._n.stop("ldap", timeout=_fs().directoryservice.ldap.timeout.stop)
 
         return obj
 
@@ -1044,16 +999,10 @@ class KerberosKeytabCreateForm(ModelForm):
                 filename = keytab_file.temporary_file_path()
                 with open(filename, "rb") as f:
                     keytab_contents = f.read()
-                    encoded = base64.b64encode(keytab_contents).decode()
             else:
-                filename = tempfile.mktemp(dir='/tmp')
-                with open(filename, 'wb+') as f:
-                    for c in keytab_file.chunks():
-                        f.write(c)
-                with open(filename, "rb") as f:
-                    keytab_contents = f.read()
-                    encoded = base64.b64encode(keytab_contents).decode()
-                os.unlink(filename)
+                # Keytabs are small, encode the upload straight from memory
+                keytab_contents = b''.join(keytab_file.chunks())
+            encoded = base64.b64encode(keytab_contents).decode()
 
         return encoded
 
@@ -1062,49 +1011,48 @@ class KerberosKeytabCreateForm(ModelForm):
             return False
 
         keytab_file = self.cleaned_data.get("keytab_file")
-        regex = re.compile(
-            '^(\d+)\s+([\w-]+(\s+\(\d+\))?)\s+([^\s]+)\s+([\d+\-]+)(\s+)?$'
-        )
 
-        tmpfile = tempfile.mktemp(dir="/tmp")
-        with open(tmpfile, 'wb') as f:
-            decoded = base64.b64decode(keytab_file)
-            f.write(decoded)
+        with tempfile.NamedTemporaryFile(dir="/tmp") as f:
+            f.write(base64.b64decode(keytab_file))
+            f.flush()
+            (res, out, err) = run("/usr/sbin/ktutil -vk '%s' list" % f.name)
 
-        (res, out, err) = run("/usr/sbin/ktutil -vk '%s' list" % tmpfile)
         if res != 0:
             log.debug("save_principals(): %s", err)
-            os.unlink(tmpfile)
             return False
 
-        os.unlink(tmpfile)
-
-        ret = False
         out = out.splitlines()
         if not out:
             return False
 
+        principals = []
         for line in out:
             line = line.strip()
-            if not line:
+            # Principal lines start with the key version number,
+            # skip ktutil headers without running the regex.
+            if not line or not line[0].isdigit():
                 continue
-            m = regex.match(line)
+            m = RE_KEYTAB_PRINCIPAL.match(line)
             if m:
-                try:
-                    kp = models.KerberosPrincipal()
-                    kp.principal_keytab = keytab
-                    kp.principal_version = int(m.group(1))
-                    kp.principal_encryption = m.group(2)
-                    kp.principal_name = m.group(4)
-                    kp.principal_timestamp = m.group(5)
-                    kp.save()
-                    ret = True
+                principals.append(models.KerberosPrincipal(
+                    principal_keytab=keytab,
+                    principal_version=int(m.group(1)),
+                    principal_encryption=m.group(2),
+                    principal_name=m.group(3),
+                    principal_timestamp=m.group(4),
+                ))
 
-                except Exception as e:
-                    log.debug("save_principals(): %s", e, exc_info=True)
-                    ret = False
+        if not principals:
+            return False
+
+        try:
+            with transaction.atomic():
+                models.KerberosPrincipal.objects.bulk_create(principals)
+        except Exception as e:
+            log.debug("save_principals(): %s", e, exc_info=True)
+            return False
 
-        return ret
+        return True
 
     def save(self):
         obj = super(KerberosKeytabCreateForm, self).save()
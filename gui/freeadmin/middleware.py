@@ -29,6 +29,7 @@ import json
 import logging
 import re
 import sys
+import threading
 import cProfile
 
 from django.conf import settings
@@ -51,12 +52,24 @@ from freenasUI.system.models import Settings
 
 log = logging.getLogger('freeadmin.middleware')
 
+_request_local = threading.local()
+
 COMMENT_SYNTAX = (
     (re.compile(r'^application/(.*\+)?xml|text/html$', re.I), '<!--', '-->'),
     (re.compile(r'^application/j(avascript|son)$', re.I), '/*', '*/'),
 )
 
 
+def request_cache():
+    """
+    Dict scoped to the HTTP request being served by the current thread.
+
+    Returns None when called outside of a request (e.g. from the API
+    or a management command), in which case callers should not cache.
+    """
+    return getattr(_request_local, 'cache', None)
+
+
 def public(f):
     f.__is_public = True
     return f
@@ -287,6 +300,23 @@ class ProfileMiddleware(object):
         return response
 
 
+class RequestCacheMiddleware(object):
+    """
+    Provides a per-request cache through `request_cache()` so forms
+    instantiated several times in the same request can share lookups.
+    """
+
+    def process_request(self, request):
+        _request_local.cache = {}
+
+    def process_response(self, request, response):
+        _request_local.cache = None
+        return response
+
+    def process_exception(self, request, exception):
+        _request_local.cache = None
+
+
 class AuthTokenMiddleware:
     HEADER_PREFIX = "Token "
 
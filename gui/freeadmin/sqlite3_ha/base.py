@@ -1,10 +1,16 @@
 
+import atexit
+import fcntl
+import functools
 import logging
 import os
+import queue
+import re
+import struct
 import threading
+import time
 
 from django.db.backends.sqlite3 import base as sqlite3base
-from lockfile import LockFile, LockTimeout
 import pickle as pickle
 import sqlparse
 
@@ -12,7 +18,9 @@ Database = sqlite3base.Database
 DatabaseError = sqlite3base.DatabaseError
 IntegrityError = sqlite3base.IntegrityError
 
+# Default for threads not within a DBSync block
 execute_sync = False
+_tls = threading.local()
 log = logging.getLogger('freeadmin.sqlite3_ha')
 
 
@@ -28,21 +36,84 @@ NO_SYNC_MAP = {
     },
 }
 
+NO_SYNC_TABLES = frozenset(NO_SYNC_MAP)
+NO_SYNC_FIELDS = {
+    table: frozenset(options['fields'])
+    for table, options in NO_SYNC_MAP.items()
+    if options and 'fields' in options
+}
+
+
+# Seconds to reuse the failover status before asking notifier again.
+# Nothing in this process is told about failover events, so for up to this
+# long after a node becomes BACKUP it may keep replicating its writes.
+FAILOVER_STATUS_TTL = 5
+_failover_status = {'ts': None, 'status': None}
+
+# notifier class, resolved on first use. Importing it while the database
+# backend is being loaded would run django.setup() recursively.
+_notifier = None
+
+
+def get_notifier():
+    """
+    Return the notifier class or None if it cannot be imported.
+    """
+    global _notifier
+    if _notifier is None:
+        try:
+            from freenasUI.middleware.notifier import notifier
+        except Exception:
+            return None
+        _notifier = notifier
+    return _notifier
+
+
+def cached_failover_status():
+    """
+    Return notifier().failover_status(), cached for FAILOVER_STATUS_TTL
+    seconds since it is very time-consuming and needed for every write.
+    A status change is only noticed once the cached value expires.
+
+    None is returned if notifier does not provide a failover status.
+    """
+    notifier = get_notifier()
+    if not hasattr(notifier, 'failover_status'):
+        return None
+
+    now = time.monotonic()
+    if (
+        _failover_status['ts'] is None or
+        now - _failover_status['ts'] > FAILOVER_STATUS_TTL
+    ):
+        _failover_status['status'] = notifier().failover_status()
+        _failover_status['ts'] = now
+    return _failover_status['status']
+
+
+def is_sync():
+    """
+    Whether queries of the current thread should be replicated synchronously.
+    """
+    return getattr(_tls, 'execute_sync', execute_sync)
+
 
 class DBSync(object):
     """
     Allow to execute all queries made within a with statement
     in a synchronous way.
-    This is not thread-safe.
+    Only affects queries made by the current thread.
     """
 
     def __enter__(self):
-        global execute_sync
-        execute_sync = True
+        self._previous = getattr(_tls, 'execute_sync', None)
+        _tls.execute_sync = True
 
     def __exit__(self, typ, value, traceback):
-        global execute_sync
-        execute_sync = False
+        if self._previous is None:
+            del _tls.execute_sync
+        else:
+            _tls.execute_sync = self._previous
         if typ is not None:
             raise
 
@@ -52,10 +123,16 @@ class Journal(object):
     Interface for accessing the journal for the queries that couldn't run in
     the remote side, either for it being offline or failed to execute.
 
+    The journal is an append-only file of length-prefixed pickled queries,
+    so adding queries does not require reading or rewriting the whole file.
+    It is only rewritten if `queries` is accessed (read or assigned).
+
     This should be used in a context and provides file locking by itself.
     """
 
     JOURNAL_FILE = '/data/ha-journal'
+    MAGIC = b'HAJ1'
+    FRAME = struct.Struct('<I')
 
     @classmethod
     def is_empty(cls):
@@ -66,70 +143,249 @@ class Journal(object):
         except OSError:
             return True
 
-    def _get_queries(self):
-        try:
-            with open(self.JOURNAL_FILE, 'rb') as f:
-                self.queries = pickle.loads(f.read())
-        except (pickle.PickleError, EOFError):
-            self.queries = []
+    def _read(self):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        with os.fdopen(os.dup(self._fd), 'rb') as f:
+            data = f.read()
+        if not data:
+            return []
 
-    def __enter__(self):
-        self._lock = LockFile(self.JOURNAL_FILE)
-        while not self._lock.i_am_locking():
+        if not data.startswith(self.MAGIC):
+            # Journal written by an older version as a single pickled list
             try:
-                self._lock.acquire(timeout=5)
-            except LockTimeout:
-                self._lock.break_lock()
-
-        if not os.path.exists(self.JOURNAL_FILE):
-            open(self.JOURNAL_FILE, 'a').close()
+                return pickle.loads(data)
+            except (pickle.PickleError, EOFError):
+                return []
+
+        queries = []
+        offset = len(self.MAGIC)
+        while offset + self.FRAME.size <= len(data):
+            size, = self.FRAME.unpack_from(data, offset)
+            offset += self.FRAME.size
+            # Partial frame from an interrupted append
+            if offset + size > len(data):
+                break
+            try:
+                queries.append(pickle.loads(data[offset:offset + size]))
+            except (pickle.PickleError, EOFError):
+                break
+            offset += size
+        return queries
+
+    def _frame(self, query):
+        data = pickle.dumps(tuple(query), protocol=pickle.HIGHEST_PROTOCOL)
+        return self.FRAME.pack(len(data)) + data
+
+    @property
+    def queries(self):
+        if self._queries is None:
+            self._queries = self._read() + self._appended
+            self._appended = []
+        return self._queries
+
+    @queries.setter
+    def queries(self, value):
+        self._queries = value
+        self._appended = []
+
+    def has_queries(self):
+        if self._queries is not None:
+            return bool(self._queries)
+        return bool(self._appended) or os.fstat(self._fd).st_size > 0
+
+    def extend(self, queries):
+        if self._queries is not None:
+            self._queries.extend(queries)
+        else:
+            self._appended.extend(queries)
 
-        self._get_queries()
+    def __enter__(self):
+        self._fd = os.open(self.JOURNAL_FILE, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        self._queries = None
+        self._appended = []
         return self
 
-    def __exit__(self, typ, value, traceback):
-
-        with open(self.JOURNAL_FILE, 'wb+') as f:
-            if self.queries:
-                f.write(pickle.dumps(self.queries))
+    def _flush(self):
+        size = os.fstat(self._fd).st_size
+        if self._queries is None and self._appended and size:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            if os.read(self._fd, len(self.MAGIC)) != self.MAGIC:
+                # Load journal from the older format so it gets converted
+                self.queries
+
+        if self._queries is not None:
+            os.ftruncate(self._fd, 0)
+            if self._queries:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, self.MAGIC + b''.join(
+                    self._frame(q) for q in self._queries
+                ))
+            os.fsync(self._fd)
+        elif self._appended:
+            os.lseek(self._fd, 0, os.SEEK_END)
+            os.write(self._fd, (b'' if size else self.MAGIC) + b''.join(
+                self._frame(q) for q in self._appended
+            ))
 
-        self._lock.release()
+    def __exit__(self, typ, value, traceback):
+        try:
+            self._flush()
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
         if typ is not None:
             raise
 
 
-class RunSQLRemote(threading.Thread):
+_remote_client = None
+
+
+def _get_remote_client():
+    """
+    Long-lived middleware client used to replicate queries.
+    Only accessed from the replication worker so no locking is required.
+    """
+    global _remote_client
+    if _remote_client is None:
+        from freenasUI.middleware.client import Client
+        _remote_client = Client()
+    return _remote_client
+
+
+def _reset_remote_client():
+    global _remote_client
+    if _remote_client is not None:
+        try:
+            _remote_client.close()
+        except Exception:
+            pass
+        _remote_client = None
+
+
+class RunSQLRemote(object):
     """
-    This is a thread responsible for running the queries on the remote side.
+    Responsible for running a batch of queries on the remote side.
 
-    The query will be appended to the Journal in case the Journal is not empty
-    or if it fails (e.g. remote side offline)
+    The queries will be appended to the Journal in case the Journal is not
+    empty or if it fails (e.g. remote side offline)
     """
 
-    def __init__(self, *args, **kwargs):
-        self._sql = kwargs.pop('sql')
-        self._params = kwargs.pop('params')
-        super(RunSQLRemote, self).__init__(*args, **kwargs)
+    def __init__(self, queries):
+        self._queries = queries
+
+    def _call_remote(self):
+        from freenasUI.middleware.client import ClientException
+        if len(self._queries) == 1:
+            method, args = 'datastore.sql', list(self._queries[0])
+        else:
+            method, args = 'datastore.sql_batch', [self._queries]
+        try:
+            _get_remote_client().call('failover.call_remote', method, args)
+        except ClientException:
+            raise
+        except Exception:
+            # Connection to middlewared has been lost, reconnect once
+            _reset_remote_client()
+            _get_remote_client().call('failover.call_remote', method, args)
 
     def run(self):
-        from freenasUI.middleware.client import client, ClientException
+        from freenasUI.middleware.client import ClientException
         try:
             with Journal() as f:
-                if f.queries:
-                    f.queries.append((self._sql, self._params))
+                if f.has_queries():
+                    f.extend(self._queries)
                 else:
-                    with client as c:
-                        c.call('failover.call_remote', 'datastore.sql', [self._sql, self._params])
+                    self._call_remote()
         except ClientException:
-            with Journal() as f:
-                f.queries.append((self._sql, self._params))
+            _reset_remote_client()
+            try:
+                with Journal() as f:
+                    f.extend(self._queries)
+            except Exception as err:
+                log.error(
+                    'Failed to journal SQL %s: %s',
+                    [q[0] for q in self._queries], err, exc_info=True,
+                )
             return False
         except Exception as err:
-            log.error('Failed to run SQL remotely %s: %s', self._sql, err, exc_info=True)
+            _reset_remote_client()
+            log.error(
+                'Failed to run SQL remotely %s: %s',
+                [q[0] for q in self._queries], err, exc_info=True,
+            )
             return False
         return True
 
 
+# Maximum number of queries sent to the remote side in a single call
+REMOTE_BATCH_SIZE = 64
+_remote_queue = queue.Queue()
+_remote_writer = None
+_remote_writer_lock = threading.Lock()
+
+
+def _remote_writer_loop():
+    """
+    Send the queued queries to the remote side in the same order they ran
+    locally. Queries queued while a batch is being sent go in the next one.
+    """
+    stop = False
+    while not stop:
+        batch = [_remote_queue.get()]
+        while len(batch) < REMOTE_BATCH_SIZE:
+            try:
+                batch.append(_remote_queue.get_nowait())
+            except queue.Empty:
+                break
+        if None in batch:
+            batch = [i for i in batch if i is not None]
+            stop = True
+        if not batch:
+            continue
+        try:
+            RunSQLRemote([(sql, params) for sql, params, done in batch]).run()
+        except Exception:
+            # Keep the writer alive, later queries still need to go out
+            log.error('Failed to replicate SQL batch', exc_info=True)
+        finally:
+            for sql, params, done in batch:
+                if done is not None:
+                    done.set()
+
+
+def _stop_remote_writer():
+    # Make sure queries still queued are sent or journaled before exiting
+    if _remote_writer is not None:
+        _remote_queue.put(None)
+        _remote_writer.join()
+
+
+def run_sql_remote(sql, params, wait=False):
+    """
+    Queue a query to be run on the remote side by the writer thread.
+
+    If `wait` is set block until the query has been sent or journaled.
+    """
+    global _remote_writer
+    if _remote_writer is None or not _remote_writer.is_alive():
+        with _remote_writer_lock:
+            if _remote_writer is None or not _remote_writer.is_alive():
+                writer = threading.Thread(
+                    target=_remote_writer_loop,
+                    name='sqlite3_ha_remote',
+                    daemon=True,
+                )
+                writer.start()
+                if _remote_writer is None:
+                    atexit.register(_stop_remote_writer)
+                _remote_writer = writer
+    done = threading.Event() if wait else None
+    _remote_queue.put((sql, params, done))
+    if done is not None:
+        done.wait()
+
+
 class DatabaseFeatures(sqlite3base.DatabaseFeatures):
     pass
 
@@ -138,8 +394,34 @@ class DatabaseOperations(sqlite3base.DatabaseOperations):
     pass
 
 
+# Column names of each table, shared by all connections and cleared by the
+# cursor whenever the schema may have changed.
+_schema_cache = {}
+DDL_PREFIXES = ('CREATE', 'ALTER', 'DROP')
+
+
+# Number of SELECTs joined with UNION ALL in a single dump query
+DUMP_COMPOUND_SELECTS = 200
+
+
+def get_fieldnames(cur, table):
+    fieldnames = _schema_cache.get(table)
+    if fieldnames is None:
+        cur.executelocal("PRAGMA table_info('%s');" % table)
+        fieldnames = _schema_cache[table] = [i[1] for i in cur.fetchall()]
+    return fieldnames
+
+
 class DatabaseWrapper(sqlite3base.DatabaseWrapper):
 
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        # The database file is copied as-is for configuration backups and
+        # replaced on upload, so stay on the rollback journal with full
+        # synchronous writes. Lock waits are covered by the `timeout` option.
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
     def create_cursor(self):
         return self.connection.cursor(factory=HASQLiteCursorWrapper)
 
@@ -148,20 +430,25 @@ class DatabaseWrapper(sqlite3base.DatabaseWrapper):
         Method responsible for dumping the database into SQL,
         excluding the tables that should not be synced between nodes.
         """
+        return list(self.iter_dump())
+
+    def iter_dump(self):
+        """
+        Generator version of `dump`, yielding one SQL statement at a time.
+        """
         cur = self.cursor()
         cur.executelocal("select name from sqlite_master where type = 'table'")
 
-        script = []
+        selects = []
         for row in cur.fetchall():
             table = row[0]
             if table in NO_SYNC_MAP:
                 tbloptions = NO_SYNC_MAP.get(table)
                 if not tbloptions:
                     continue
-            cur.executelocal("PRAGMA table_info('%s');" % table)
-            fieldnames = [i[1] for i in cur.fetchall()]
-            script.append('DELETE FROM %s' % table)
-            cur.executelocal('SELECT %s FROM %s' % (
+            fieldnames = get_fieldnames(cur, table)
+            selects.append("SELECT 'DELETE FROM %s'" % table)
+            selects.append('SELECT %s FROM %s' % (
                 "'INSERT INTO %s (%s) VALUES (' || %s ||')'" % (
                     table,
                     ', '.join(['`%s`' % f for f in fieldnames]),
@@ -171,10 +458,15 @@ class DatabaseWrapper(sqlite3base.DatabaseWrapper):
                 ),
                 table,
             ))
-            for row in cur.fetchall():
-                script.append(row[0])
 
-        return script
+        # Fetch all the tables with a few compound queries rather than one
+        # query per table, staying below SQLITE_MAX_COMPOUND_SELECT.
+        for i in range(0, len(selects), DUMP_COMPOUND_SELECTS):
+            cur.executelocal(
+                ' UNION ALL '.join(selects[i:i + DUMP_COMPOUND_SELECTS])
+            )
+            for row in cur:
+                yield row[0]
 
     def dump_recv(self, script):
         """
@@ -185,6 +477,8 @@ class DatabaseWrapper(sqlite3base.DatabaseWrapper):
         cur = self.cursor()
         cur.executelocal("select name from sqlite_master where type = 'table'")
 
+        # Local rows to restore after the script, as (query, rows)
+        preserve = []
         for row in cur.fetchall():
             table = row[0]
             # Skip in case table is supposed to sync
@@ -196,45 +490,46 @@ class DatabaseWrapper(sqlite3base.DatabaseWrapper):
             # This chunck of code may not be really necessary for now.
             tbloptions = NO_SYNC_MAP.get(table)
             if not tbloptions:
-                cur.executelocal("PRAGMA table_info('%s');" % table)
-                fieldnames = [i[1] for i in cur.fetchall()]
-                script.append('DELETE FROM %s' % table)
+                fieldnames = ['`%s`' % f for f in get_fieldnames(cur, table)]
                 cur.executelocal('SELECT %s FROM %s' % (
-                    "'INSERT INTO %s (%s) VALUES (' || %s ||')'" % (
+                    ', '.join(fieldnames), table,
+                ))
+                script.append('DELETE FROM %s' % table)
+                preserve.append((
+                    'INSERT INTO %s (%s) VALUES (%s)' % (
                         table,
-                        ', '.join(['`%s`' % f for f in fieldnames]),
-                        " || ',' || ".join(
-                            ['quote(`%s`)' % field for field in fieldnames]
-                        ),
+                        ', '.join(fieldnames),
+                        ', '.join(['?'] * len(fieldnames)),
                     ),
-                    table,
+                    cur.fetchall(),
                 ))
-                for row in cur.fetchall():
-                    script.append(row[0])
 
             # If the table has fields restrictions, update these fields
             # exclusively.
             else:
-                fieldnames = tbloptions['fields']
-                cur.executelocal('SELECT %s FROM %s' % (
-                    "'UPDATE %s SET ' || %s || ' WHERE id = ' || id" % (
+                fieldnames = ['`%s`' % f for f in tbloptions['fields']]
+                cur.executelocal('SELECT %s, id FROM %s' % (
+                    ', '.join(fieldnames), table,
+                ))
+                preserve.append((
+                    'UPDATE %s SET %s WHERE id = ?' % (
                         table,
-                        " || ', ' || ".join([
-                            "'`%s` = ' || quote(`%s`)" % (f, f)
-                            for f in fieldnames
-                        ]),
+                        ', '.join(['%s = ?' % f for f in fieldnames]),
                     ),
-                    table,
+                    cur.fetchall(),
                 ))
-                for row in cur.fetchall():
-                    script.append(row[0])
 
-        # Execute the script within a transaction
+        # Execute the script and restore local values within a transaction
         cur.executescript(';'.join(
-            ['PRAGMA foreign_keys=OFF', 'BEGIN TRANSACTION'] + script + [
-                'COMMIT;'
-            ]
+            ['PRAGMA foreign_keys=OFF', 'BEGIN TRANSACTION'] + script
         ))
+        try:
+            for query, rows in preserve:
+                cur.executemany(query, rows)
+        except Exception:
+            cur.executelocal('ROLLBACK')
+            raise
+        cur.executelocal('COMMIT')
 
         with Journal() as j:
             j.queries = []
@@ -242,161 +537,259 @@ class DatabaseWrapper(sqlite3base.DatabaseWrapper):
         return True
 
 
-class HASQLiteCursorWrapper(Database.Cursor):
+# Statements that never need to be replicated
+PASSIVE_SKIP_PREFIXES = (
+    'SELECT', 'PRAGMA', 'BEGIN', 'COMMIT', 'SAVEPO', 'RELEAS', 'ROLLBA',
+)
+RE_PASSIVE_TABLE = re.compile(
+    r'^\s*(?:INSERT\s+INTO|DELETE\s+FROM|UPDATE)\s+[`"\[]?(\w+)', re.I
+)
 
-    def execute_passive(self, query, params=None):
-        """
-        Process the query, modify it if necessary based on NO_SYNC_MAP rules
-        and execute it on the remote side.
-        """
-        global execute_sync
 
-        # Skip SELECT queries
-        if query.lower().startswith('select'):
-            return
+def _unquote(name):
+    return name.strip('`"[]')
 
-        try:
-            # FIXME: This is extremely time-consuming (failover.status)
-            from freenasUI.middleware.notifier import notifier
-            if not (
-                hasattr(notifier, 'failover_status') and
-                notifier().failover_status() == 'MASTER'
-            ):
-                return
-        except:
-            return
 
-        parse = sqlparse.parse(query)
-        for p in parse:
+def _table_name(token):
+    """
+    Table name of the token following INTO/FROM/UPDATE, which may carry
+    quotes and, for INSERT, the list of columns.
+    """
+    return _unquote(token.value.split('(', 1)[0].strip())
+
+
+def _adjacent_comma(tokens, index, step, removed):
+    """
+    Return the index of the comma next to tokens[index] walking in the
+    `step` direction, ignoring whitespace and tokens already removed.
+    """
+    index += step
+    while 0 <= index < len(tokens):
+        token = tokens[index]
+        if index not in removed and not token.is_whitespace:
+            return index if token.value == ',' else None
+        index += step
+    return None
+
+
+@functools.lru_cache(maxsize=512)
+def passive_statements(query):
+    """
+    Parse the query and rewrite it based on NO_SYNC_MAP rules.
+
+    Returns a tuple of (sql, delete_idx) for every statement to be run on
+    the remote side, where delete_idx are the positions of the params to be
+    dropped, in reverse order.
+
+    Django generates a small set of distinct queries so the result is cached
+    instead of tokenizing the same query over and over.
+    """
+    # Most writes are single statements on tables which are fully synced,
+    # these can be replicated verbatim without tokenizing them.
+    reg = RE_PASSIVE_TABLE.match(query)
+    if reg and reg.group(1) not in NO_SYNC_TABLES and ';' not in query:
+        return ((query, ()),)
+
+    statements = []
+    parse = sqlparse.parse(query)
+    for p in parse:
+
+        # Only care for DELETE, INSERT and UPDATE queries
+        if p.tokens[0].normalized not in ('DELETE', 'INSERT', 'UPDATE'):
+            continue
+
+        # Remember correspondent params to delete
+        delete_idx = []
+
+        if p.tokens[0].normalized == 'INSERT':
 
-            # Only care for DELETE, INSERT and UPDATE queries
-            if p.tokens[0].normalized not in ('DELETE', 'INSERT', 'UPDATE'):
+            into = p.token_next_by(m=(sqlparse.tokens.Keyword, 'INTO'))
+            if not into:
                 continue
 
-            cparams = list(params)
-            if p.tokens[0].normalized == 'INSERT':
+            next_ = p.token_next(into[0])
 
-                into = p.token_next_by(m=(sqlparse.tokens.Keyword, 'INTO'))
-                if not into:
-                    continue
+            if _table_name(next_[1]) in NO_SYNC_TABLES:
+                continue
 
-                next_ = p.token_next(into[0])
+        elif p.tokens[0].normalized == 'DELETE':
 
-                if next_[1].value in NO_SYNC_MAP:
-                    continue
+            from_ = p.token_next_by(m=(sqlparse.tokens.Keyword, 'FROM'))
+            if not from_:
+                continue
 
-            elif p.tokens[0].normalized == 'DELETE':
+            next_ = p.token_next(from_[0])
 
-                from_ = p.token_next_by(m=(sqlparse.tokens.Keyword, 'FROM'))
-                if not from_:
-                    continue
+            if _table_name(next_[1]) in NO_SYNC_TABLES:
+                continue
 
-                next_ = p.token_next(from_[0])
+        elif p.tokens[0].normalized == 'UPDATE':
 
-                if next_[1].value in NO_SYNC_MAP:
-                    continue
+            name = _table_name(p.token_next(0)[1])
+            no_sync_fields = NO_SYNC_FIELDS.get(name)
+            # Skip if table is in set to not to sync and has no fields
+            if no_sync_fields is None and name in NO_SYNC_TABLES:
+                continue
 
-            elif p.tokens[0].normalized == 'UPDATE':
+            set_ = p.token_next_by(m=(sqlparse.tokens.Keyword, 'SET'))
+            if not set_:
+                continue
 
-                name = p.token_next(0)[1].value
-                no_sync = NO_SYNC_MAP.get(name)
-                # Skip if table is in set to not to sync and has no attrs
-                if no_sync is None and name in NO_SYNC_MAP:
-                    continue
+            next_ = p.token_next(set_[0])
+            if not next_:
+                continue
 
-                set_ = p.token_next_by(m=(sqlparse.tokens.Keyword, 'SET'))
-                if not set_:
+            lookup = []
+            if no_sync_fields is not None:
+
+                if issubclass(
+                    next_[1].__class__, sqlparse.sql.IdentifierList
+                ):
+                    lookup = list(next_[1].get_sublists())
+                elif issubclass(next_[1].__class__, sqlparse.sql.Comparison):
+                    lookup = [next_[1]]
+
+                # Get all placeholders from the query (%s or ?)
+                placeholders_idx = {
+                    id(a): i for i, a in enumerate(
+                        a for a in p.flatten() if a.value in ('%s', '?')
+                    )
+                }
+
+            # Tokens to drop, grouped by parent so every parent token list
+            # is scanned and rebuilt only once.
+            removals = {}
+            removed = 0
+            for l in lookup:
+
+                if _unquote(l.left.value) not in no_sync_fields:
                     continue
+                removed += 1
+
+                # Remove placeholder from the params
+                idx = placeholders_idx.get(id(l.tokens[-1]))
+                if idx is not None:
+                    delete_idx.append(idx)
+
+                parent = l.parent
+                if id(parent) not in removals:
+                    removals[id(parent)] = (parent, {
+                        id(t): i for i, t in enumerate(parent.tokens)
+                    }, set())
+                parent, positions, to_remove = removals[id(parent)]
+                t_index = positions[id(l)]
+                to_remove.add(t_index)
+
+                # If it is a list we must also remove the comma around it
+                comma = _adjacent_comma(parent.tokens, t_index, 1, to_remove)
+                if comma is None:
+                    comma = _adjacent_comma(
+                        parent.tokens, t_index, -1, to_remove
+                    )
+                if comma is not None:
+                    to_remove.add(comma)
+
+            # Nothing left to set on the remote side
+            if lookup and removed == len(lookup):
+                continue
 
-                next_ = p.token_next(set_[0])
-                if not next_:
-                    continue
+            for parent, positions, to_remove in removals.values():
+                parent.tokens = [
+                    t for i, t in enumerate(parent.tokens)
+                    if i not in to_remove
+                ]
+
+            delete_idx.sort(reverse=True)
+
+        statements.append((str(p), tuple(delete_idx)))
+
+    return tuple(statements)
+
+
+# Allow sync to be bypassed just to be extra safe on things like
+# database migration.
+# Alternatively a south driver could be written bu the effort would be
+# quite significant.
+SKIP_PASSIVE_SENTINEL = '/tmp/.sqlite3_ha_skip'
+# Seconds to reuse the result of looking for the sentinel file
+SKIP_PASSIVE_TTL = 1.0
+_skip_passive = {'ts': None, 'skip': False}
+
+
+def skip_passive():
+    """
+    Whether the sentinel file owned by root exists, checked at most once
+    every SKIP_PASSIVE_TTL seconds instead of for every query.
+    """
+    now = time.monotonic()
+    if (
+        _skip_passive['ts'] is None or
+        now - _skip_passive['ts'] > SKIP_PASSIVE_TTL
+    ):
+        try:
+            skip = os.stat(SKIP_PASSIVE_SENTINEL).st_uid == 0
+        except OSError:
+            skip = False
+        _skip_passive['skip'] = skip
+        _skip_passive['ts'] = now
+    return _skip_passive['skip']
+
+
+# Translate "%s" to "?" and unescape "%%" in a single pass
+RE_CONVERT_QUERY = re.compile(r'%%|%s')
+
+
+def _convert_placeholder(m):
+    return '%' if m.group() == '%%' else '?'
 
-                if no_sync is None:
-                    lookup = []
-                else:
 
-                    if 'fields' not in no_sync:
-                        continue
-
-                    if issubclass(
-                        next_[1].__class__, sqlparse.sql.IdentifierList
-                    ):
-                        lookup = list(next_[1].get_sublists())
-                    elif issubclass(next_[1].__class__, sqlparse.sql.Comparison):
-                        lookup = [next_[1]]
-
-                    # Get all placeholders from the query (%s or ?)
-                    placeholders = [a for a in p.flatten() if a.value in ('%s', '?')]
-
-                # Remember correspondent cparams to delete
-                delete_idx = []
-
-                for l in lookup:
-
-                    if l.value not in no_sync['fields']:
-                        continue
-
-                    # Remove placeholder from the params
-                    try:
-                        idx = placeholders.index(l.tokens[-1])
-                        if cparams:
-                            delete_idx.append(idx)
-                    except ValueError:
-                        pass
-
-                    # If it is a list we must also remove the comma around it
-                    t_index = l.parent.token_index(l)
-                    prev_ = l.parent.token_prev(t_index)
-                    next_ = l.parent.token_next(t_index)
-                    if next_ and issubclass(
-                        next_[1].__class__, sqlparse.sql.Token
-                    ) and next_[1].value == ',':
-                        del l.parent.tokens[next_[0]]
-                    elif prev_ and issubclass(
-                        prev_[1].__class__, sqlparse.sql.Token
-                    ) and prev_[1].value == ',':
-                        del l.parent.tokens[prev_[0]]
-                    del l.parent.tokens[l.parent.token_index(l)]
-
-                delete_idx.sort(reverse=True)
+class HASQLiteCursorWrapper(Database.Cursor):
+
+    def execute_passive(self, query, params=None):
+        """
+        Process the query, modify it if necessary based on NO_SYNC_MAP rules
+        and execute it on the remote side.
+        """
+        # Skip queries that do not change data
+        if query[:6].upper().startswith(PASSIVE_SKIP_PREFIXES):
+            return
+
+        try:
+            if cached_failover_status() != 'MASTER':
+                return
+        except:
+            return
+
+        for sql, delete_idx in passive_statements(query):
+            cparams = list(params)
+            if cparams:
                 for i in delete_idx:
                     del cparams[i]
 
             if params is not None:
-                sql = self.convert_query(str(p))
-            else:
-                sql = str(p)
+                sql = self.convert_query(sql)
             # Actually try to run the query on the remote side within a thread
-            rsr = RunSQLRemote(sql=sql, params=cparams)
-            rsr.start()
-            if execute_sync:
-                rsr.join()
+            run_sql_remote(sql, cparams, wait=is_sync())
 
     def execute(self, query, params=None):
 
+        if query.lstrip()[:6].upper().startswith(DDL_PREFIXES):
+            _schema_cache.clear()
+
         if params is None:
             return super().execute(query)
         query = self.convert_query(query)
         execute = super().execute(query, params)
 
-        # Allow sync to be bypassed just to be extra safe on things like
-        # database migration.
-        # Alternatively a south driver could be written bu the effort would be
-        # quite significant.
-        skip_passive_sentinel = '/tmp/.sqlite3_ha_skip'
-        skip = False
-        if os.path.exists(skip_passive_sentinel):
-            try:
-                skip = os.stat(skip_passive_sentinel).st_uid == 0
-            except OSError:
-                pass
-        if not skip:
+        if not skip_passive():
             self.execute_passive(query, params=params)
 
         return execute
 
     def executelocal(self, query, params=None):
+        if query.lstrip()[:6].upper().startswith(DDL_PREFIXES):
+            _schema_cache.clear()
+
         if params is None:
             return super().execute(query)
         query = self.convert_query(query)
@@ -407,6 +800,7 @@ class HASQLiteCursorWrapper(Database.Cursor):
         return super().executemany(query, param_list)
 
     def convert_query(self, query):
-        return sqlite3base.FORMAT_QMARK_REGEX.sub('?', query).replace(
-            '%%', '%'
-        )
+        # Queries without any "%" (e.g. already using "?") need no work
+        if '%' not in query:
+            return query
+        return RE_CONVERT_QUERY.sub(_convert_placeholder, query)
@@ -95,44 +95,49 @@ define([
         indeterminate: false
       });
     },
-    update: function(uuid) {
-
-      var updateProgress = function(data) {
-        if(!data) return;
-        if(data.step) {
-          me._curStep = data.step;
-        }
-        if(data.details) {
-          me.dapDetails.innerHTML = data.details;
-        }
-        if(data.percent) {
-          if(data.percent == 100) {
-            me._subProgress.update({'indeterminate': true});
-            me._masterProgress(data.percent);
-            if(me._curStep == me._numSteps)
-              return;
-          } else {
-            me._subProgress.update({
-              maximum: 100,
-              progress: data.percent,
-              indeterminate: false
-            });
-            me._masterProgress(data.percent);
-          }
+    _updateLabel: function() {
+      if(!this.importProgress) {
+        this.message = this.steps[this._curStep - 1];
+        this.dapMainLabel.innerHTML = sprintf("(%d/%d) %s", this._curStep, this._numSteps, this.message.label);
+      } else
+        this.dapMainLabel.innerHTML = this._message;
+    },
+    setProgress: function(data) {
+      /*
+       * Display progress pushed by the caller (e.g. from middleware job
+       * events) instead of polling poolUrl.
+       */
+      if(!data || !this.dapMainLabel) return;
+      if(data.step) {
+        this._curStep = data.step;
+      }
+      this._updateLabel();
+      if(data.details) {
+        this.dapDetails.innerHTML = data.details;
+      }
+      if(data.percent) {
+        if(data.percent == 100) {
+          this._subProgress.update({'indeterminate': true});
+          this._masterProgress(data.percent);
         } else {
-          me._masterProgress(0);
-          me._subProgress.update({'indeterminate': true});
+          this._subProgress.update({
+            maximum: 100,
+            progress: data.percent,
+            indeterminate: false
+          });
+          this._masterProgress(data.percent);
         }
-      };
+      } else {
+        this._masterProgress(0);
+        this._subProgress.update({'indeterminate': true});
+      }
+    },
+    update: function(uuid) {
 
       var me = this;
       if(uuid) this.uuid = uuid;
       if(!this.dapMainLabel) return;
-      if(!this.importProgress) {
-        this.message = this.steps[this._curStep - 1];
-        this.dapMainLabel.innerHTML = sprintf("(%d/%d) %s", this._curStep, this._numSteps, this.message.label);
-      } else
-        this.dapMainLabel.innerHTML = this._message;
+      this._updateLabel();
       if(this.fileUpload && this._curStep == 1) {
         xhr.get('/progress', {
           headers: {"X-Progress-ID": me.uuid}
@@ -203,7 +208,7 @@ define([
             headers: {"X-Progress-ID": me.uuid},
             handleAs: "json"
           }).then(function(data) {
-            updateProgress(data);
+            me.setProgress(data);
             setTimeout(function() {
               me.update();
             }, 1000);
@@ -21,7 +21,6 @@ define([
   "dijit/form/TextBox",
   "dijit/form/SimpleTextarea",
   "dijit/popup",
-  "dojox/uuid/generateRandomUuid",
   "freeadmin/Progress",
   "dojo/text!freeadmin/templates/supportticket.html",
   "dojo/text!freeadmin/templates/supportticket_attachment.html"
@@ -48,7 +47,6 @@ define([
   TextBox,
   SimpleTextarea,
   popup,
-  generateRandomUuid,
   Progress,
   template,
   templateAttachment) {
@@ -83,7 +81,6 @@ define([
       errorMessage: "",
       initial: "",
       categoriesUrl: "",
-      progressUrl: "",
       softwareName: "",
       templateString: template,
       postCreate: function() {
@@ -452,12 +449,8 @@ define([
           });
         }
 
-        var uuid = generateRandomUuid();
-
         var progressbar = new Progress({
-          poolUrl: this.progressUrl,
-          steps: steps,
-          uuid: uuid
+          steps: steps
         });
 
         if(!this.validate()) return false;
@@ -487,6 +480,9 @@ define([
         this._submit.set('disabled', true);
 
         Middleware.call('support.new_ticket', [data], function(data) {
+          if(fileUpload) {
+            progressbar.setProgress({step: 2});
+          }
           me.attachFiles(data.result.ticket).then(function(attach_res) {
             me.dapErrorMessage.innerHTML = '';
             domStyle.set(me.dapErrorMessageRow, "display", "none");
@@ -509,11 +505,14 @@ define([
             submitting.destroyRecursive();
 
             me._submit.set('disabled', false);
-        }, true, function(progress) {
-          //console.log("progress", progress);
+        }, true, function(job) {
+          progressbar.setProgress({
+            percent: job.progress.percent,
+            details: job.progress.description
+          });
         });
 
-        progressbar.update(uuid);
+        progressbar.setProgress({});
 
         submitting.show();
 
@@ -76,11 +76,20 @@ from freenasUI.middleware.client import client
 from freenasUI.middleware.exceptions import MiddlewareError
 from middlewared.plugins.pwenc import encrypt, decrypt
 
+from lxml import etree
 import sysctl
 
 ACL_WINDOWS_FILE = ".windows"
 ACL_MAC_FILE = ".mac"
 RE_DSKNAME = re.compile(r'^([a-z]+)([0-9]+)$')
+# GEOM tree lookups used by label_to_disk, compiled once
+XPATH_LABEL_PROVIDER = etree.XPath(
+    "//class[name = 'LABEL']//provider[name = $name]/../consumer/provider/@ref"
+)
+XPATH_DEV_PROVIDER = etree.XPath(
+    "//class[name = 'DEV']/geom[name = $name]//provider/@ref"
+)
+XPATH_PROVIDER_GEOM_NAME = etree.XPath("//provider[@id = $id]/../name")
 log = logging.getLogger('middleware.notifier')
 
 
@@ -888,7 +897,6 @@ class notifier(metaclass=HookMetaclass):
         self.__confxml = None
 
     def _geom_confxml(self):
-        from lxml import etree
         if self.__confxml is None:
             self.__confxml = etree.fromstring(self.sysctl('kern.geom.confxml'))
         return self.__confxml
@@ -901,19 +909,19 @@ class notifier(metaclass=HookMetaclass):
         doc = self._geom_confxml()
 
         # try to find the provider from GEOM_LABEL
-        search = doc.xpath("//class[name = 'LABEL']//provider[name = '%s']/../consumer/provider/@ref" % name)
+        search = XPATH_LABEL_PROVIDER(doc, name=name)
         if len(search) > 0:
             provider = search[0]
         else:
             # the label does not exist, try to find it in GEOM DEV
-            search = doc.xpath("//class[name = 'DEV']/geom[name = '%s']//provider/@ref" % name)
+            search = XPATH_DEV_PROVIDER(doc, name=name)
             if len(search) > 0:
                 provider = search[0]
             else:
                 return None
-        search = doc.xpath("//provider[@id = '%s']/../name" % provider)
+        search = XPATH_PROVIDER_GEOM_NAME(doc, id=provider)
         disk = search[0].text
-        if search[0].getparent().getparent().xpath("./name")[0].text in ('ELI', ):
+        if search[0].getparent().getparent().findtext("name") in ('ELI', ):
             return self.label_to_disk(disk.replace(".eli", ""))
         return disk
 
@@ -27,33 +27,49 @@ import bisect
 import libzfs
 import logging
 import re
-import subprocess
+from sys import intern
 
-from collections import defaultdict, OrderedDict
+from collections import OrderedDict
 from django.utils.translation import ugettext_lazy as _
 
 log = logging.getLogger('middleware.zfs')
 
 ZPOOL_NAME_RE = r'[a-z][a-z0-9_\-\.]*'
+VDEV_NAMES = frozenset(('stripe', 'mirror', 'raidz', 'raidz1', 'raidz2', 'raidz3'))
+# Names which may be followed by "-<index>"
+VDEV_INDEXED_NAMES = frozenset(('mirror', 'raidz', 'raidz1', 'raidz2', 'raidz3', 'spare'))
+# raidz needs to appear after other raidz types
+VDEV_TYPES = ('stripe', 'mirror', 'raidz3', 'raidz2', 'raidz', 'spare-')
+
+# zpool status parsing
+SCAN_SCRUB_RE = re.compile(r'scan: (scrub.+?)\b[a-z]+:', re.M | re.S)
+SCAN_RESILVER_RE = re.compile(r'scan: (resilver.+?)\b[a-z]+:', re.M | re.S)
+# Statistics of a scrub/resilver, found in a single pass over the scan text
+SCAN_FIELDS_RE = re.compile(
+    r'(?P<progress>\S+)% done'
+    r'|(?P<repaired>\S+) repaired,'
+    r'|(?P<scanned>\S+) scanned out of (?P<total>\S+)'
+    r'|(?P<togo>\S+) to go'
+    r'|with (?P<errors>\S+) errors'
+    r'|repaired (?P<repaired_in>\S+) in'
+    r'|on (?P<date>.+\d{2} \d{4})'
+)
+POOL_ID_RE = re.compile(r'id: (?P<id>\d+)')
 
 
 def _is_vdev(name):
     """
     Find out if a given name is a reserved word in zfs
     """
-    if (
-        name in ('stripe', 'mirror', 'raidz', 'raidz1', 'raidz2', 'raidz3')
-        or
-        re.search(r'^(mirror|raidz|raidz1|raidz2|raidz3|spare)(-\d+)?$', name)
-    ):
+    if name in VDEV_NAMES:
         return True
-    return False
+    # e.g. mirror-0, raidz2-1, spare-3
+    base, dash, index = name.partition('-')
+    return base in VDEV_INDEXED_NAMES and (not dash or index.isdecimal())
 
 
 def _vdev_type(name):
-    # raidz needs to appear after other raidz types
-    supported_types = ('stripe', 'mirror', 'raidz3', 'raidz2', 'raidz', 'spare-')
-    for _type in supported_types:
+    for _type in VDEV_TYPES:
         if name.startswith(_type):
             return _type
     return False
@@ -74,11 +90,29 @@ class Pool(object):
     logs = None
 
     def __init__(self, pid, name, scrub, resilver=None):
+        self._guid_paths = None
+        self._dev_index = None
         self.id = pid
         self.name = name
         self.scrub = scrub
         self.resilver = resilver
 
+    def get_path_by_guid(self, guid):
+        """
+        Get the path of the vdev with the given guid.
+        All vdevs are looked up at once using a single libzfs handle.
+        """
+        if self._guid_paths is None:
+            self._guid_paths = {}
+            try:
+                with libzfs.ZFS() as zfs:
+                    for vdev in walk_vdevs(zfs.get(self.name).groups):
+                        self._guid_paths[vdev.guid] = vdev.path
+            except libzfs.ZFSException as e:
+                if e.code.name != 'NOENT':
+                    raise
+        return self._guid_paths.get(guid)
+
     def __getitem__(self, name):
         if hasattr(self, name):
             return getattr(self, name)
@@ -98,43 +132,51 @@ class Pool(object):
         else:
             setattr(self, root.name, root)
         root.parent = self
+        self._dev_index = None
+
+    def _roots(self):
+        """
+        Roots present in this pool, in the order they are displayed
+        """
+        return [
+            root for root in (self.data, self.cache, self.spares, self.logs)
+            if root is not None
+        ]
 
     def find_not_online(self):
         """
         Get disks used within this pool
         """
         unavails = []
-        for key in ('data', 'cache', 'spares', 'logs'):
-            if getattr(self, key):
-                unavails.extend(getattr(self, key).find_not_online())
+        for root in self._roots():
+            unavails.extend(root.find_not_online())
         return unavails
 
     def get_dev_by_name(self, name):
-        for dev in self.get_devs():
-            if dev.name == name:
-                return dev
+        if self._dev_index is None:
+            self._dev_index = {}
+            for dev in self.iter_devs():
+                self._dev_index.setdefault(dev.name, dev)
+        return self._dev_index.get(name)
+
+    def iter_devs(self):
+        for root in self._roots():
+            for vdev in root.children:
+                yield from vdev.iter_devs()
 
     def get_devs(self):
         """
         Get disks used within this pool
         """
-        devs = []
-        for key in ('data', 'cache', 'spares', 'logs'):
-            klass = getattr(self, key)
-            if klass is None:
-                continue
-            for vdev in klass:
-                devs.extend(vdev.get_devs())
-        return devs
+        return list(self.iter_devs())
 
     def get_disks(self):
         """
         Get disks used within this pool
         """
         disks = []
-        for key in ('data', 'cache', 'spares', 'logs'):
-            if getattr(self, key):
-                disks.extend(getattr(self, key).get_disks())
+        for root in self._roots():
+            disks.extend(root.iter_disks())
         return disks
 
     def validate(self):
@@ -142,18 +184,11 @@ class Pool(object):
         Validate the current tree
         by calling specialized methods
         """
-        for key in ('data', 'cache', 'spares', 'logs'):
-            if getattr(self, key):
-                getattr(self, key).validate()
+        for root in self._roots():
+            root.validate()
 
     def dump(self):
-        data = []
-        for key in ('data', 'cache', 'spares', 'logs'):
-            if getattr(self, key):
-                data.append(
-                    getattr(self, key).dump()
-                )
-        return data
+        return [root.dump() for root in self._roots()]
 
     def __repr__(self):
         return repr({
@@ -174,10 +209,11 @@ class Tnode(object):
     type = None
     status = None
 
-    def __init__(self, name, doc, **kwargs):
-        self._doc = doc
+    def __init__(self, name, geom, **kwargs):
+        self._geom = geom
         self.name = name
         self.children = []
+        self._children_by_name = {}
         self.status = kwargs.pop('status', None)
         self.read = kwargs.pop('read', 0)
         self.write = kwargs.pop('write', 0)
@@ -187,10 +223,24 @@ class Tnode(object):
         """
         Find children by a given name
         """
-        for child in self.children:
-            if child.name == name:
-                return child
-        return None
+        return self._children_by_name.get(name)
+
+    def _add_child(self, node):
+        self.children.append(node)
+        self._children_by_name.setdefault(node.name, node)
+        node.parent = self
+
+    def remove(self, node):
+        """
+        Remove a child node
+        """
+        self.children.remove(node)
+        if self._children_by_name.get(node.name) is node:
+            del self._children_by_name[node.name]
+            for child in self.children:
+                if child.name == node.name:
+                    self._children_by_name[node.name] = child
+                    break
 
     def find_not_online(self):
         """
@@ -251,8 +301,7 @@ class Root(Tnode):
         """
         if not isinstance(node, Vdev):
             raise Exception("Not a vdev: %s" % node)
-        self.children.append(node)
-        node.parent = self
+        self._add_child(node)
 
     def dump(self):
         vdevs = []
@@ -265,14 +314,15 @@ class Root(Tnode):
             'status': self.status if self.status else '',
         }
 
+    def iter_disks(self):
+        for vdev in self.children:
+            yield from vdev.iter_disks()
+
     def get_disks(self):
         """
         Get disks used within this root
         """
-        disks = []
-        for vdev in self:
-            disks.extend(vdev.get_disks())
-        return disks
+        return list(self.iter_disks())
 
     def validate(self):
         for vdev in self:
@@ -288,40 +338,38 @@ class Vdev(Tnode):
     def __repr__(self):
         return "<Section: %s>" % self.name
 
-    def get_disks(self):
-        disks = []
-        for child in self:
+    def iter_disks(self):
+        for child in self.children:
             if isinstance(child, Vdev):
-                disks.extend(child.get_disks())
-            else:
-                if child.disk:
-                    disks.append(child.disk)
-        return disks
+                yield from child.iter_disks()
+            elif child.disk:
+                yield child.disk
+
+    def get_disks(self):
+        return list(self.iter_disks())
 
     def append(self, node):
         """
         Append a Dev
         """
         if isinstance(node, Dev) or isinstance(node, Vdev):
-            self.children.append(node)
-            node.parent = self
+            self._add_child(node)
         else:
             raise Exception("Not a dev/vdev: %s" % node)
 
-    def get_devs(self):
-        # Returns all children of self which are devs ( Dev objects )
-        disk_objects = []
-        for child in self:
+    def iter_devs(self):
+        # Yields all children of self which are devs ( Dev objects )
+        for child in self.children:
             if isinstance(child, Vdev):
-                disk_objects.extend(child.get_devs())
+                yield from child.iter_devs()
             else:
-                disk_objects.append(child)
-        return disk_objects
+                yield child
+
+    def get_devs(self):
+        return list(self.iter_devs())
 
     def dump(self):
-        disks = []
-        for dev in self.get_devs():
-            disks.append(dev.dump())
+        disks = [dev.dump() for dev in self.iter_devs()]
         return {
             'name': self.name,
             'disks': disks,
@@ -339,10 +387,10 @@ class Vdev(Tnode):
         if len(self.children) == 0:
             stripe = self.parent.find_by_name("stripe")
             if not stripe:
-                stripe = Tnode("stripe", self._doc)
+                stripe = Tnode("stripe", self._geom)
                 stripe.type = 'stripe'
                 self.parent.append(stripe)
-            self.parent.children.remove(self)
+            self.parent.remove(self)
             stripe.append(self)
         else:
             self.type = _vdev_type(self.name)
@@ -377,28 +425,17 @@ class Dev(Tnode):
                 "Oh noes! This damn thing should be a vdev! %s" % self.parent
             )
 
+        geom = self._geom
         name = self.name
-        search = self._doc.xpath(
-            "//class[name = 'ELI']"
-            "//provider[name = '%s']/../consumer"
-            "/provider/@ref" % name
-        )
-        if len(search) > 0:
-            search = self._doc.xpath(
-                "//provider[@id = '%s']/name" % search[0]
-            )
-            name = search[0].text
+        ref = geom.eli.get(name)
+        if ref is not None:
+            name = geom.provider_names.get(ref)
 
-        search = self._doc.xpath(
-            "//class[name = 'LABEL']"
-            "//provider[name = '%s']/../consumer"
-            "/provider" % name
-        )
+        label = geom.label.get(name)
 
         provider = None
-        if len(search) > 0:
-            self.devname = search[0].xpath("../../name")[0].text
-            provider = search[0].attrib.get('ref')
+        if label is not None:
+            self.devname, provider = label
         else:
 
             # Treat .nop as a regular dev (w/o .nop)
@@ -406,13 +443,9 @@ class Dev(Tnode):
                 self.devname = self.name[:-4]
             else:
                 self.devname = self.name
-            search = self._doc.xpath(
-                "//class[name = 'DEV']"
-                "/geom[name = '%s']"
-                "//provider/@ref" % self.devname
-            )
-            if len(search) > 0:
-                provider = search[0]
+            ref = geom.dev.get(self.devname)
+            if ref is not None:
+                provider = ref
             elif self.status == 'ONLINE':
                 log.warn("It should be a valid device: %s", self.name)
                 self.disk = self.name
@@ -421,20 +454,66 @@ class Dev(Tnode):
                 while getattr(pool, 'parent', None):
                     pool = pool.parent
                 # Lets check whether it is a guid
-                try:
-                    with libzfs.ZFS() as zfs:
-                        vdev = zfs.get(pool.name).vdev_by_guid(int(self.name))
-                        if vdev:
-                            self.path = vdev.path
-                except libzfs.ZFSException as e:
-                    if e.code.name != 'NOENT':
-                        raise
+                self.path = pool.get_path_by_guid(int(self.name))
 
         if provider:
-            search = self._doc.xpath(
-                "//provider[@id = '%s']/../name" % provider
-            )
-            self.disk = search[0].text
+            self.disk = geom.geom_names[provider]
+
+
+class GeomIndex(object):
+    """
+    Lookup tables of the GEOM tree (kern.geom.confxml) needed to find the
+    disk of every Dev, built in a single pass over the document instead of
+    searching the whole tree for each device.
+    """
+
+    def __init__(self, doc):
+        # ELI provider name -> provider id the ELI geom consumes
+        self.eli = {}
+        # LABEL provider name -> (geom name, provider id the geom consumes)
+        self.label = {}
+        # DEV geom name -> provider id the geom consumes
+        self.dev = {}
+        # provider id -> provider name
+        self.provider_names = {}
+        # provider id -> name of the geom of the provider
+        self.geom_names = {}
+
+        for provider in doc.iter('provider'):
+            pid = provider.get('id')
+            if pid is not None and pid not in self.provider_names:
+                self.provider_names[pid] = provider.findtext('name')
+                self.geom_names[pid] = provider.getparent().findtext('name')
+
+        for klass in doc.iter('class'):
+            cname = klass.findtext('name')
+            if cname == 'DEV':
+                for geom in klass.iterfind('geom'):
+                    ref = self._consumed(geom, './/provider')
+                    if ref is not None:
+                        self.dev.setdefault(geom.findtext('name'), ref)
+            elif cname in ('ELI', 'LABEL'):
+                for provider in klass.iterfind('.//provider[name]'):
+                    geom = provider.getparent()
+                    name = provider.findtext('name')
+                    if cname == 'ELI':
+                        ref = self._consumed(geom, 'consumer/provider')
+                        if ref is not None:
+                            self.eli.setdefault(name, ref)
+                    else:
+                        consumer = geom.find('consumer/provider')
+                        if consumer is not None:
+                            self.label.setdefault(name, (
+                                geom.findtext('name'), consumer.get('ref'),
+                            ))
+
+    @staticmethod
+    def _consumed(geom, path):
+        for provider in geom.iterfind(path):
+            ref = provider.get('ref')
+            if ref is not None:
+                return ref
+        return None
 
 
 class ZFSList(OrderedDict):
@@ -461,17 +540,11 @@ class ZFSList(OrderedDict):
             names = names[1:]
         item = self.get(search, None)
         if item:
-            while names:
-                found = False
-                search = names[0]
-                names = names[1:]
-                for child in item.children:
-                    if child.name.rsplit('/', 1)[-1] == search:
-                        item = child
-                        found = True
-                        break
-                if not found:
+            for search in names:
+                child = item._child_by_leaf.get(search)
+                if child is None:
                     break
+                item = child
         return item
 
     def __getitem__(self, item):
@@ -497,31 +570,35 @@ class ZFSDataset(object):
     parent = None
     children = None
 
-    properties = [
+    properties = frozenset([
         'atime', 'used', 'usedsnap', 'usedds', 'usedrefreserv', 'usedchild',
         'avail', 'refer', 'mountpoint', 'sync', 'compression', 'dedup',
         'description', 'quota', 'refquota', 'readonly', 'exec', 'recordsize',
         'reservation', 'refreservation',
-    ]
+    ])
 
     def __init__(self, path=None, props=None, local=None, default=None, inherit=None, include_root=False):
         self.path = path
         if path:
+            pool, sep, name = path.partition('/')
             if include_root:
-                self.pool = path.split('/', 1)[0]
+                self.pool = pool
                 self.name = path
+            elif sep:
+                self.pool = pool
+                self.name = name
             else:
-                if '/' in path:
-                    self.pool, self.name = path.split('/', 1)
-                else:
-                    self.pool = ''
-                    self.name = path
-        self.__props = props or {}
+                self.pool = ''
+                self.name = path
+        props = props or {}
+        for prop in self.properties:
+            setattr(self, prop, props.get(prop))
         self.parent = None
         self.local = local or []
         self.default = default or []
         self.inherit = inherit or []
         self.children = []
+        self._child_by_leaf = {}
 
     def __repr__(self):
         return "<Dataset: %s>" % self.path
@@ -529,12 +606,6 @@ class ZFSDataset(object):
     def __lt__(self, other):
         return self.path < other.path
 
-    def __getattribute__(self, attr):
-        if attr in object.__getattribute__(self, 'properties'):
-            return self.__props.get(attr)
-        else:
-            return object.__getattribute__(self, attr)
-
     @property
     def full_name(self):
         if self.pool:
@@ -544,11 +615,13 @@ class ZFSDataset(object):
     def append(self, child):
         child.parent = self
         self.children.append(child)
+        self._child_by_leaf.setdefault(child.name.rsplit('/', 1)[-1], child)
 
     def _get_used_pct(self):
+        used = self.used
         try:
-            return int((float(self.used) / float(self.avail + self.used)) * 100.0)
-        except:
+            return used * 100 // (self.avail + used)
+        except Exception:
             return _("Error")
 
     used_pct = property(_get_used_pct)
@@ -563,23 +636,28 @@ class ZFSVol(object):
     parent = None
     children = None
 
-    properties = [
+    properties = frozenset([
         'used', 'usedsnap', 'usedds', 'usedrefreserv', 'usedchild',
         'avail', 'refer', 'volsize', 'sync', 'compression', 'dedup',
         'description', 'readonly',
-    ]
+    ])
 
     def __init__(self, path=None, props=None):
         self.path = path
         if path:
-            if '/' in path:
-                self.pool, self.name = path.split('/', 1)
+            pool, sep, name = path.partition('/')
+            if sep:
+                self.pool = pool
+                self.name = name
             else:
                 self.pool = ''
                 self.name = path
-        self.__props = props
+        props = props or {}
+        for prop in self.properties:
+            setattr(self, prop, props.get(prop))
         self.parent = None
         self.children = []
+        self._child_by_leaf = {}
 
     def __repr__(self):
         return "<ZFSVol: %s>" % self.path
@@ -587,12 +665,6 @@ class ZFSVol(object):
     def __lt__(self, other):
         return self.path < other.path
 
-    def __getattribute__(self, attr):
-        if attr in object.__getattribute__(self, 'properties'):
-            return self.__props.get(attr)
-        else:
-            return object.__getattribute__(self, attr)
-
     @property
     def full_name(self):
         if self.pool:
@@ -602,11 +674,13 @@ class ZFSVol(object):
     def append(self, child):
         child.parent = self
         self.children.append(child)
+        self._child_by_leaf.setdefault(child.name.rsplit('/', 1)[-1], child)
 
     def _get_used_pct(self):
+        used = self.used
         try:
-            return int((float(self.used) / float(self.avail + (self.used - self.usedrefreserv))) * 100.0)
-        except:
+            return used * 100 // (self.avail + (used - self.usedrefreserv))
+        except Exception:
             return _("Error")
 
     used_pct = property(_get_used_pct)
@@ -648,13 +722,25 @@ class Snapshot(object):
         return "%s@%s" % (self.filesystem, self.name)
 
 
+def _scan_fields(scan):
+    """
+    Get the statistics found in the scan text, first occurrence wins
+    """
+    fields = {}
+    for reg in SCAN_FIELDS_RE.finditer(scan):
+        for key, value in reg.groupdict().items():
+            if value is not None and key not in fields:
+                fields[key] = value
+    return fields
+
+
 def parse_status(name, doc, data):
 
     """
     Parse the scrub statistics from zpool status
     The scrub is within scan: tag and may have multiple lines
     """
-    scan = re.search(r'scan: (scrub.+?)\b[a-z]+:', data, re.M | re.S)
+    scan = SCAN_SCRUB_RE.search(data)
     scrub = {}
     if scan:
         scan = scan.group(1)
@@ -673,22 +759,12 @@ def parse_status(name, doc, data):
                 scrub_status = 'PAUSED'
                 scrub_statusv = _('Paused')
 
-            reg = re.search(r'(\S+)% done', scan)
-            if reg:
-                scrub['progress'] = Decimal(reg.group(1))
-
-            reg = re.search(r'(\S+) repaired,', scan)
-            if reg:
-                scrub['repaired'] = reg.group(1)
-
-            reg = re.search(r'(\S+) scanned out of (\S+)', scan)
-            if reg:
-                scrub['scanned'] = reg.group(1)
-                scrub['total'] = reg.group(2)
-
-            reg = re.search(r'(\S+) to go', scan)
-            if reg:
-                scrub['togo'] = reg.group(1)
+            fields = _scan_fields(scan)
+            if 'progress' in fields:
+                scrub['progress'] = Decimal(fields['progress'])
+            for key in ('repaired', 'scanned', 'total', 'togo'):
+                if key in fields:
+                    scrub[key] = fields[key]
 
         elif scan.find('scrub repaired') != -1:
             scrub.update({
@@ -698,17 +774,12 @@ def parse_status(name, doc, data):
             })
             scrub_status = 'COMPLETED'
             scrub_statusv = _('Completed')
-            reg = re.search(r'with (\S+) errors', scan)
-            if reg:
-                scrub['errors'] = reg.group(1)
-
-            reg = re.search(r'repaired (\S+) in', scan)
-            if reg:
-                scrub['repaired'] = reg.group(1)
-
-            reg = re.search(r'on (.+\d{2} \d{4})', scan)
-            if reg:
-                scrub['date'] = reg.group(1)
+            fields = _scan_fields(scan)
+            for key in ('errors', 'date'):
+                if key in fields:
+                    scrub[key] = fields[key]
+            if 'repaired_in' in fields:
+                scrub['repaired'] = fields['repaired_in']
 
         elif scan.find('scrub canceled') != -1:
             scrub_status = 'CANCELED'
@@ -727,7 +798,7 @@ def parse_status(name, doc, data):
     """
     Parse the resilver statistics from zpool status
     """
-    scan = re.search(r'scan: (resilver.+?)\b[a-z]+:', data, re.M | re.S)
+    scan = SCAN_RESILVER_RE.search(data)
     resilver = {}
     if scan:
         scan = scan.group(1)
@@ -740,18 +811,12 @@ def parse_status(name, doc, data):
             })
             resilver_status = 'IN_PROGRESS'
             resilver_statusv = _('In Progress')
-            reg = re.search(r'(\S+)% done', scan)
-            if reg:
-                resilver['progress'] = Decimal(reg.group(1))
-
-            reg = re.search(r'(\S+) scanned out of (\S+)', scan)
-            if reg:
-                resilver['scanned'] = reg.group(1)
-                resilver['total'] = reg.group(2)
-
-            reg = re.search(r'(\S+) to go', scan)
-            if reg:
-                resilver['togo'] = reg.group(1)
+            fields = _scan_fields(scan)
+            if 'progress' in fields:
+                resilver['progress'] = Decimal(fields['progress'])
+            for key in ('scanned', 'total', 'togo'):
+                if key in fields:
+                    resilver[key] = fields[key]
 
         elif scan.find('resilvered') != -1:
             resilver.update({
@@ -760,13 +825,10 @@ def parse_status(name, doc, data):
             })
             resilver_status = 'COMPLETED'
             resilver_statusv = _('Completed')
-            reg = re.search(r'with (\S+) errors', scan)
-            if reg:
-                resilver['errors'] = reg.group(1)
-
-            reg = re.search(r'on (.+\d{2} \d{4})', scan)
-            if reg:
-                resilver['date'] = reg.group(1)
+            fields = _scan_fields(scan)
+            for key in ('errors', 'date'):
+                if key in fields:
+                    resilver[key] = fields[key]
 
         elif scan.find('resilver canceled') != -1:
             resilver_status = 'CANCELED'
@@ -783,11 +845,12 @@ def parse_status(name, doc, data):
         resilver['status_verbose'] = _('None requested')
 
     status = data.split('config:')[1]
-    pid = re.search(r'id: (?P<id>\d+)', data)
+    pid = POOL_ID_RE.search(data)
     if pid:
         pid = pid.group("id")
     else:
         pid = None
+    geom = GeomIndex(doc)
     pool = Pool(pid=pid, name=name, scrub=scrub, resilver=resilver)
     lastident = None
     pnode = None
@@ -795,29 +858,30 @@ def parse_status(name, doc, data):
         if not line.startswith('\t'):
             continue
 
-        try:
-            spaces, word, status, read, write, cksum = re.search(
-                r'''^(?P<spaces>[ ]*)  # Group spaces to know identation
-                    (?P<word>\S+)\s+
-                    (?P<status>\S+)\s+
-                    (?P<read>\S+)\s+(?P<write>\S+)\s+(?P<cksum>\S+)''',
-                line[1:],
-                re.X
-            ).groups()
-        except Exception:
-            spaces, word, status = re.search(
-                r'^(?P<spaces>[ ]*)(?P<word>\S+)(?:\s+(?P<status>\S+))?',
-                line[1:]
-            ).groups()
+        line = line[1:]
+        parts = line.split()
+        if not parts:
+            continue
+        word = parts[0]
+        if len(parts) >= 5:
+            status, read, write, cksum = parts[1:5]
+        else:
+            status = parts[1] if len(parts) > 1 else None
             read, write, cksum = 0, 0, 0
-        ident = int(len(spaces) / 2)
+        # Only a handful of distinct statuses exist, share a single string
+        # for each of them across all the nodes of the tree.
+        if status is not None:
+            status = intern(status)
+        # Group spaces to know identation
+        ident = (len(line) - len(line.lstrip(' '))) // 2
+        # Cheap integer checks first, most lines do not go up the tree
         if (
+                lastident is not None and
+                ident < lastident and
                 (
                     ident < 2 or
-                    (pnode.name.startswith('spare-') and ident == 2)
-                ) and
-                lastident is not None and
-                ident < lastident
+                    (ident == 2 and pnode.name.startswith('spare-'))
+                )
         ):
             for x in range(lastident - ident):
                 pnode = pnode.parent
@@ -826,7 +890,7 @@ def parse_status(name, doc, data):
             if word != 'NAME':
                 tree = Root(
                     word,
-                    doc,
+                    geom,
                     read=read,
                     write=write,
                     cksum=cksum,
@@ -839,7 +903,7 @@ def parse_status(name, doc, data):
             if _is_vdev(word):
                 node = Vdev(
                     word,
-                    doc,
+                    geom,
                     status=status,
                     read=read,
                     write=write,
@@ -851,7 +915,7 @@ def parse_status(name, doc, data):
                 if lastident != ident:
                     node = Vdev(
                         "stripe",
-                        doc,
+                        geom,
                         read=read,
                         write=write,
                         cksum=cksum,
@@ -864,7 +928,7 @@ def parse_status(name, doc, data):
 
                 node2 = Dev(
                     word,
-                    doc,
+                    geom,
                     status=status,
                     read=read,
                     write=write,
@@ -877,7 +941,7 @@ def parse_status(name, doc, data):
                 if ident == 2 and word.startswith('spare-'):
                     node = Vdev(
                         word,
-                        doc,
+                        geom,
                         read=read,
                         write=write,
                         cksum=cksum,
@@ -886,15 +950,11 @@ def parse_status(name, doc, data):
                     pnode.append(node)
                     pnode = node
                 else:
-                    if ident == 3:
-                        replacing = True
-                    else:
-                        replacing = False
                     node = Dev(
                         word,
-                        doc,
+                        geom,
                         status=status,
-                        replacing=replacing,
+                        replacing=ident == 3,
                         read=read,
                         write=write,
                         cksum=cksum,
@@ -908,75 +968,146 @@ def parse_status(name, doc, data):
     return pool
 
 
+# (zfs property, attribute) pairs common to filesystems and volumes
+ZFS_INT_PROPS = (
+    ('available', 'avail'),
+    ('used', 'used'),
+    ('usedbysnapshots', 'usedsnap'),
+    ('usedbydataset', 'usedds'),
+    ('usedbyrefreservation', 'usedrefreserv'),
+    ('usedbychildren', 'usedchild'),
+    ('referenced', 'refer'),
+)
+ZFS_STR_PROPS = (
+    ('sync', 'sync'),
+    ('compression', 'compression'),
+    ('dedup', 'dedup'),
+    ('readonly', 'readonly'),
+    ('org.freenas:description', 'description'),
+)
+
+
+def _maybe_int(value):
+    """
+    Integer value of a raw ZFS property, None for "-", "none" and friends
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _iter_children(ds, depth):
+    if depth < 1:
+        return
+    for child in ds.children:
+        yield child
+        yield from _iter_children(child, depth - 1)
+
+
+def _iter_datasets(zfs, path, recursive, depth=None):
+    """
+    Iterate over the datasets `zfs get` would report for `path`
+
+    `depth` limits recursion like `zfs get -d`, relative to `path` or to
+    the pool root datasets when no path is given.
+    """
+    if not path:
+        if depth is None:
+            yield from zfs.datasets
+            return
+        for pool in zfs.pools:
+            ds = pool.root_dataset
+            yield ds
+            yield from _iter_children(ds, depth)
+        return
+    try:
+        ds = zfs.get_dataset(path)
+    except libzfs.ZFSException:
+        return
+    yield ds
+    if depth is not None:
+        yield from _iter_children(ds, depth)
+    elif recursive:
+        yield from ds.children_recursive
+
+
+def _zfs_list_cache():
+    """
+    Per-request cache of zfs_list results, None outside of a request
+    """
+    # freeadmin.middleware pulls in models which import this module
+    from freenasUI.freeadmin.middleware import request_cache
+    cache = request_cache()
+    if cache is None:
+        return None
+    return cache.setdefault('zfs_list', {})
+
+
+def invalidate_zfs_cache():
+    """
+    Drop zfs_list results cached for the current request.
+
+    Must be called after creating, updating or destroying datasets.
+    """
+    cache = _zfs_list_cache()
+    if cache is not None:
+        cache.clear()
+
+
 def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
-             types=None):
+             types=None, depth=None):
     """
     Return a dictionary that contains all ZFS dataset list and their
     mountpoints
+
+    `depth` limits how many levels of children are listed and implies
+    `recursive`, like `zfs list -d`.
+
+    Results are cached for the duration of the HTTP request, callers
+    must not modify the returned list.
     """
-    args = [
-        "/sbin/zfs",
-        "get",
-        "-p",
-        "-H",
-        "-t", ",".join(types or ['filesystem', 'volume']),
-        "-o", "name,property,value,source",
-        "all",
-    ]
-    if recursive:
-        args.insert(3, "-r")
-
-    if path:
-        args.append(path)
-
-    zfsproc = subprocess.Popen(
-        args,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        encoding='utf8')
-
-    zfs_output, zfs_err = zfsproc.communicate()
-    zfs_output = zfs_output.split('\n')
-    zfsget = defaultdict(OrderedDict)
-    for line in zfs_output:
-        if not line:
-            continue
-        data = line.split('\t')
-        zfsget[data[0]][data[1]] = (data[2], data[3])
+    types = tuple(types or ('filesystem', 'volume'))
+    cache = _zfs_list_cache()
+    if cache is None:
+        return _zfs_list(
+            path, recursive, hierarchical, include_root, types, depth,
+        )
+    key = (path, recursive, hierarchical, include_root, types, depth)
+    zfslist = cache.get(key)
+    if zfslist is None:
+        zfslist = cache[key] = _zfs_list(
+            path, recursive, hierarchical, include_root, types, depth,
+        )
+    return zfslist
+
+
+def _zfs_list(path, recursive, hierarchical, include_root, types, depth):
+    zfsget = {}
+    with libzfs.ZFS() as zfs:
+        for ds in _iter_datasets(zfs, path, recursive, depth):
+            if ds.type.name.lower() not in types:
+                continue
+            zfsget[ds.name] = {
+                k: (v.rawvalue, v.source.name.lower())
+                for k, v in ds.properties.items()
+            }
 
     zfslist = ZFSList()
-    for path, props in zfsget.items():
+    # Same order as `zfs get`, parents always come before their children
+    for path, props in sorted(zfsget.items()):
         names = path.split('/')
-        depth = len(names)
         # root filesystem is not treated as dataset by us
-        if depth == 1 and not include_root:
+        if len(names) == 1 and not include_root:
             continue
 
         zprops = {}
-        for pname, dname, ptype in (
-            ('available', 'avail', int),
-            ('used', 'used', int),
-            ('usedbysnapshots', 'usedsnap', int),
-            ('usedbydataset', 'usedds', int),
-            ('usedbyrefreservation', 'usedrefreserv', int),
-            ('usedbychildren', 'usedchild', int),
-            ('referenced', 'refer', int),
-            ('sync', 'sync', str),
-            ('compression', 'compression', str),
-            ('dedup', 'dedup', str),
-            ('readonly', 'readonly', str),
-            ('org.freenas:description', 'description', str),
-        ):
-            if pname not in props:
-                zprops[dname] = None
-                continue
-            if ptype is int:
-                if props[pname][0].isdigit():
-                    zprops[dname] = int(props[pname][0])
-                else:
-                    zprops[dname] = None
-            else:
-                zprops[dname] = props[pname][0]
+        for pname, dname in ZFS_INT_PROPS:
+            value = props.get(pname)
+            zprops[dname] = _maybe_int(value[0]) if value is not None else None
+        for pname, dname in ZFS_STR_PROPS:
+            value = props.get(pname)
+            zprops[dname] = value[0] if value is not None else None
 
         local_props = []
         default_props = []
@@ -993,11 +1124,11 @@ def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
         if _type == 'filesystem':
             zprops['atime'] = props['atime'][0]
             zprops['mountpoint'] = props['mountpoint'][0]
-            zprops['quota'] = int(props['quota'][0]) if props['quota'][0].isdigit() else None
-            zprops['refquota'] = int(props['refquota'][0]) if props['refquota'][0].isdigit() else None
-            zprops['reservation'] = int(props['reservation'][0]) if props['reservation'][0].isdigit() else None
-            zprops['refreservation'] = int(props['refreservation'][0]) if props['refreservation'][0].isdigit() else None
-            zprops['recordsize'] = int(props['recordsize'][0]) if props['recordsize'][0].isdigit() else None
+            zprops['quota'] = _maybe_int(props['quota'][0])
+            zprops['refquota'] = _maybe_int(props['refquota'][0])
+            zprops['reservation'] = _maybe_int(props['reservation'][0])
+            zprops['refreservation'] = _maybe_int(props['refreservation'][0])
+            zprops['recordsize'] = _maybe_int(props['recordsize'][0])
             zprops['exec'] = props['exec'][0]
             if props['exec'][1].startswith('inherited'):
                 inherit_props.append('exec')
@@ -1010,7 +1141,7 @@ def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
                 inherit=inherit_props,
             )
         elif _type == 'volume':
-            zprops['volsize'] = int(props['volsize'][0]) if props['volsize'][0].isdigit() else None
+            zprops['volsize'] = _maybe_int(props['volsize'][0])
             item = ZFSVol(
                 path=path,
                 props=zprops,
@@ -1032,58 +1163,68 @@ def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
 
 
 def list_datasets(path="", recursive=False, hierarchical=False,
-                  include_root=False):
+                  include_root=False, depth=None):
     return zfs_list(
         path=path,
         recursive=recursive,
         hierarchical=hierarchical,
         include_root=include_root,
+        depth=depth,
         types=["filesystem"],
     )
 
 
-def zpool_list(name=None):
-    zfsproc = subprocess.Popen([
-        'zpool',
-        'list',
-        '-o', 'name,size,alloc,free,cap',
-        '-p',
-        '-H',
-    ] + ([name] if name else []), stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8')
-
-    output = zfsproc.communicate()[0].strip('\n')
-    if zfsproc.returncode != 0:
-        raise SystemError('zpool list failed')
+ZPOOL_LIST_PROPS = (
+    ('size', 'size'),
+    ('allocated', 'alloc'),
+    ('free', 'free'),
+    ('capacity', 'capacity'),
+)
+
 
+def zpool_list(name=None):
     rv = {}
-    for line in output.split('\n'):
-        data = line.split('\t')
-        attrs = {
-            'name': data[0],
-            'size': int(data[1]) if data[1].isdigit() else None,
-            'alloc': int(data[2]) if data[2].isdigit() else None,
-            'free': int(data[3]) if data[3].isdigit() else None,
-            'capacity': int(data[4]) if data[4].isdigit() else None,
-        }
-        rv[attrs['name']] = attrs
+    with libzfs.ZFS() as zfs:
+        try:
+            pools = [zfs.get(name)] if name else list(zfs.pools)
+        except libzfs.ZFSException:
+            raise SystemError('zpool list failed')
+        for pool in pools:
+            attrs = {'name': pool.name}
+            props = pool.properties
+            for pname, dname in ZPOOL_LIST_PROPS:
+                attrs[dname] = _maybe_int(props[pname].rawvalue)
+            rv[pool.name] = attrs
 
     if name:
         return rv[name]
     return rv
 
 
-def zfs_ashift_from_label(pool, label):
+def zfs_ashift_from_labels(pool, labels):
+    """
+    Return the configured ashift of each label (vdev guid or device name)
+    of the pool, None for labels that are not found
+    """
     with libzfs.ZFS() as zfs:
         pool = zfs.get(pool)
         if not pool:
-            return None
-        if label.isdigit():
-            vdev = pool.vdev_by_guid(int(label))
-        else:
-            vdev = vdev_by_path(pool.groups, '/dev/' + label)
-        if not vdev:
-            return None
-        return vdev.stats.configured_ashift
+            return [None] * len(labels)
+        index = None
+        rv = []
+        for label in labels:
+            if label.isdigit():
+                vdev = pool.vdev_by_guid(int(label))
+            else:
+                if index is None:
+                    index = index_vdevs(pool.groups)
+                vdev = index.get('/dev/' + label)
+            rv.append(vdev.stats.configured_ashift if vdev else None)
+        return rv
+
+
+def zfs_ashift_from_label(pool, label):
+    return zfs_ashift_from_labels(pool, [label])[0]
 
 
 def iterate_vdevs(topology):
@@ -1096,8 +1237,30 @@ def iterate_vdevs(topology):
                     yield subvdev
 
 
+def walk_vdevs(topology):
+    """
+    Iterate over all vdevs of the topology, including nested ones
+    """
+    def walk(vdevs):
+        for vdev in vdevs:
+            yield vdev
+            if vdev.children:
+                yield from walk(vdev.children)
+
+    for group in topology.values():
+        yield from walk(group)
+
+
+def index_vdevs(topology):
+    """
+    Map device paths to the vdevs yielded by iterate_vdevs
+    """
+    index = {}
+    for vdev in iterate_vdevs(topology):
+        if vdev.path:
+            index.setdefault(vdev.path, vdev)
+    return index
+
+
 def vdev_by_path(topology, path):
-    for i in iterate_vdevs(topology):
-        if i.path == path:
-            return i
-    return None
+    return index_vdevs(topology).get(path)
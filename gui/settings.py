@@ -151,6 +151,7 @@ TEMPLATES = [{
 
 MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
+    'freenasUI.freeadmin.middleware.RequestCacheMiddleware',
     #'freenasUI.freeadmin.middleware.ProfileMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -58,6 +58,7 @@ from freenasUI.middleware.client import client, ClientException, ValidationError
 from freenasUI.middleware.exceptions import MiddlewareError
 from freenasUI.middleware.form import MiddlewareModelForm
 from freenasUI.middleware.notifier import notifier
+from freenasUI.middleware import zfs
 from freenasUI.middleware.util import JobAborted, JobFailed, upload_job_and_wait
 from freenasUI.storage import models
 from freenasUI.storage.widgets import UnixPermissionField
@@ -1225,6 +1226,7 @@ class ZFSDatasetCreateForm(ZFSDatasetCommonForm):
             with client as c:
                 c.call('pool.dataset.create', dict(
                     data, name=f"{self.parentdata['name']}/{self.cleaned_data['dataset_name']}", type="FILESYSTEM"))
+            zfs.invalidate_zfs_cache()
 
             return True
         except ValidationErrors as e:
@@ -1340,6 +1342,7 @@ class ZFSDatasetEditForm(ZFSDatasetCommonForm):
         try:
             with client as c:
                 c.call('pool.dataset.update', self._fs, data)
+            zfs.invalidate_zfs_cache()
 
             return True
         except ValidationErrors as e:
@@ -1481,6 +1484,7 @@ class ZVol_EditForm(CommonZVol):
         try:
             with client as c:
                 c.call('pool.dataset.update', self.name, data)
+            zfs.invalidate_zfs_cache()
 
             return True
         except ClientException as e:
@@ -1565,6 +1569,7 @@ class ZVol_CreateForm(CommonZVol):
             with client as c:
                 c.call('pool.dataset.create', dict(data, name=f"{self.parentds}/{self.cleaned_data['zvol_name']}",
                                                    type="VOLUME"))
+            zfs.invalidate_zfs_cache()
 
             return True
         except ValidationErrors as e:
@@ -1920,6 +1925,7 @@ class CloneSnapshotForm(Form):
                 })
             except Exception as e:
                 return str(e)
+        zfs.invalidate_zfs_cache()
         return ''
 
 
@@ -2426,9 +2432,11 @@ class CommonDatasetDestroy:
         super().done()
         try:
             with client as c:
-                return c.call('pool.dataset.delete', self.fs, {
+                rv = c.call('pool.dataset.delete', self.fs, {
                     'recursive': self.cleaned_data.get('cascade') or False,
                 })
+            zfs.invalidate_zfs_cache()
+            return rv
         except ClientException as e:
             self._errors['__all__'] = self.error_class([str(e)])
             return False
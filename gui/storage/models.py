@@ -169,11 +169,14 @@ class Volume(Model):
         return self.vol_name
 
     def _get__zplist(self):
-        if not hasattr(self, '__zplist'):
-            try:
-                self.__zplist = zfs.zpool_list().get(self.vol_name)
-            except SystemError:
-                self.__zplist = None
+        try:
+            return self.__zplist
+        except AttributeError:
+            pass
+        try:
+            self.__zplist = zfs.zpool_list(name=self.vol_name)
+        except SystemError:
+            self.__zplist = None
         return self.__zplist
 
     def _set__zplist(self, value):
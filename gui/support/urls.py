@@ -27,7 +27,7 @@
 from django.conf.urls import url
 
 from .views import (
-    index, eula, license_update, license_status, ticket_categories, ticket_progress,
+    index, eula, license_update, license_status, ticket_categories,
     download_guide
 )
 
@@ -38,6 +38,5 @@ urlpatterns = [
     url(r'^license/update/$', license_update, name="support_license_update"),
     url(r'^license/status/$', license_status, name="support_license_status"),
     url(r'^ticket/categories/$', ticket_categories, name="support_ticket_categories"),
-    url(r'^ticket/progress/$', ticket_progress, name="support_ticket_progress"),
     url(r'^guide/$', download_guide, name="download_guide"),
 ]
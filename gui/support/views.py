@@ -23,16 +23,14 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 #####################################################################
-from collections import OrderedDict
-import json
 import logging
 import os
+import ujson
 
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect
 from django.shortcuts import render
 from django.utils.translation import ugettext as _
 from django.views.decorators.http import require_POST
-from wsgiref.util import FileWrapper
 
 from freenasUI.common.system import get_sw_name, get_sw_version
 from freenasUI.freeadmin.apppool import appPool
@@ -42,7 +40,18 @@ from freenasUI.middleware.notifier import notifier
 from freenasUI.support import forms, utils
 
 log = logging.getLogger("support.views")
-TICKET_PROGRESS = '/tmp/.ticketprogress'
+EULA_FILE = '/usr/local/share/truenas/eula.html'
+
+
+def _load_eula():
+    if not os.path.exists(EULA_FILE):
+        return None
+    with open(EULA_FILE, 'r', encoding='utf8') as f:
+        return f.read()
+
+
+# Only shipped with TrueNAS and replaced on upgrade, which restarts the GUI
+_EULA_HTML = _load_eula()
 
 
 def index(request):
@@ -56,9 +65,11 @@ def index(request):
     sw_name = get_sw_name().lower()
 
     license, reason = utils.get_license()
+    _n = notifier()
+    is_freenas = _n.is_freenas()
     allow_update = True
-    if hasattr(notifier, 'failover_status'):
-        status = notifier().failover_status()
+    if hasattr(_n, 'failover_status'):
+        status = _n.failover_status()
         if status not in ('MASTER', 'SINGLE'):
             allow_update = False
 
@@ -70,11 +81,10 @@ def index(request):
     }
     for c in appPool.hook_view_context('support.index', request):
         context.update(c)
-    if not notifier().is_freenas():
+    if not is_freenas:
         with client as c:
             context['eula_not_accepted'] = not c.call('truenas.is_eula_accepted')
 
-    if not notifier().is_freenas():
         form = forms.ProductionForm()
         if request.method == 'POST':
             form = forms.ProductionForm(request.POST)
@@ -91,15 +101,10 @@ def index(request):
 
 
 def eula(request):
-    eula = None
-    if os.path.exists('/usr/local/share/truenas/eula.html'):
-        with open('/usr/local/share/truenas/eula.html', 'r', encoding='utf8') as f:
-            eula = f.read()
-
     return render(request, 'eula.html', {
         'sw_name': get_sw_name(),
         'sw_version': get_sw_version(),
-        'eula': eula,
+        'eula': _EULA_HTML,
         'hide_buttons': True,
     })
 
@@ -107,6 +112,8 @@ def eula(request):
 def license_update(request):
 
     license, reason = utils.get_license()
+    _n = notifier()
+    is_freenas = _n.is_freenas()
     if request.method == 'POST':
         form = forms.LicenseUpdateForm(request.POST)
         if form.is_valid():
@@ -114,8 +121,7 @@ def license_update(request):
                 f.write(form.cleaned_data.get('license').encode('ascii'))
             events = []
             try:
-                _n = notifier()
-                if not _n.is_freenas():
+                if not is_freenas:
                     with client as c:
                         _n.sync_file_send(c, utils.LICENSE_FILE)
                 form.done(request, events)
@@ -129,9 +135,8 @@ def license_update(request):
         else:
             return JsonResp(request, form=form)
     else:
-        _n = notifier()
         try:
-            if not _n.is_freenas() and _n.failover_licensed():
+            if not is_freenas and _n.failover_licensed():
                 with client as c:
                     c.call('failover.call_remote', 'core.ping')
         except ClientException:
@@ -139,10 +144,8 @@ def license_update(request):
         form = forms.LicenseUpdateForm()
 
     eula = None
-    if not notifier().is_freenas():
-        if os.path.exists('/usr/local/share/truenas/eula.html'):
-            with open('/usr/local/share/truenas/eula.html', 'r', encoding='utf8') as f:
-                eula = f.read()
+    if not is_freenas:
+        eula = _EULA_HTML
 
     return render(request, 'support/license_update.html', {
         'eula': eula,
@@ -180,40 +183,22 @@ def ticket_categories(request):
     }
 
     if success:
-        data['categories'] = OrderedDict(
-            sorted([('------', '')] + list(msg.items()), key=lambda y: y[0].lower())
-        )
+        categories = [('------', '')]
+        categories.extend(msg.items())
+        categories.sort(key=lambda y: y[0].casefold())
+        data['categories'] = dict(categories)
     else:
         data['message'] = msg
 
-    return HttpResponse(json.dumps(data), content_type='application/json')
-
-
-def ticket_progress(request):
-    try:
-        with client as c:
-            jobs = c.call('core.get_jobs', [('method', '=', 'support.new_ticket')], {'order_by': ['-id']})
-            job = jobs[0]
-            if job['state'] == 'SUCCESS':
-                data = {'step': 2, 'indeterminate': True}
-            elif job['state'] == 'RUNNING':
-                data = {
-                    'percent': job['progress']['percent'],
-                    'details': job['progress']['description'],
-                }
-            else:
-                data = {'indeterminate': True}
-    except Exception:
-        data = {'indeterminate': True}
-    return HttpResponse(json.dumps(data), content_type='application/json')
+    return HttpResponse(ujson.dumps(data), content_type='application/json')
 
 
 def download_guide(request):
     if not notifier().is_freenas():
         pdf_path = '/usr/local/www/data/docs_legacy/TrueNAS.pdf'
-        with open(pdf_path, 'rb') as f:
-            wrapper = FileWrapper(f)
-            response = HttpResponse(wrapper, content_type='application/pdf')
-            response['Content-Length'] = os.path.getsize(pdf_path)
-            response['Content-Disposition'] = 'attachment; filename=TrueNAS_Userguide.pdf'
-            return response
+        # FileResponse closes the file once it has been sent
+        f = open(pdf_path, 'rb')
+        response = FileResponse(f, content_type='application/pdf')
+        response['Content-Length'] = os.fstat(f.fileno()).st_size
+        response['Content-Disposition'] = 'attachment; filename=TrueNAS_Userguide.pdf'
+        return response
@@ -30,10 +30,8 @@ import json
 import logging
 import math
 import os
-import pickle as pickle
 import re
 import stat
-import subprocess
 import threading
 import time
 from collections import OrderedDict, defaultdict
@@ -45,6 +43,7 @@ from django.core.files.storage import FileSystemStorage
 from django.db.models import Q
 from django.forms import FileField
 from django.forms.formsets import BaseFormSet, formset_factory
+from django.forms.models import model_to_dict
 from django.http import HttpResponse
 from django.shortcuts import render_to_response
 from django.utils import timezone
@@ -86,40 +85,98 @@ from ldap import LDAPError
 log = logging.getLogger('system.forms')
 WIZARD_PROGRESSFILE = '/tmp/.initialwizard_progress'
 LEGACY_MANUAL_UPGRADE = None
+UNUSED_DISKS_CACHE_KEY = 'unused_disks'
+UNUSED_DISKS_CACHE_TIMEOUT = 5
+RE_DISK_SORT = re.compile(r'^.*?([0-9]+)[^0-9]*([0-9]*).*$')
+# Wrapper for responses read back through dojo.io.frame (file uploads)
+TEXTAREA_PREFIX = '<html><body><textarea>'
+TEXTAREA_SUFFIX = '</textarea></body></html>'
 
 
 def clean_path_execbit(path):
     """
     Make sure the hierarchy has the bit S_IXOTH set
     """
-    current = path
+    # Resolve symlinks once, the parents of a canonical path are canonical
+    current = os.path.realpath(path)
     while True:
         try:
             mode = os.stat(current).st_mode
-            if mode & stat.S_IXOTH == 0:
-                raise forms.ValidationError(
-                    _("The path '%s' requires an execute permission bit.") % (
-                        current,
-                    )
-                )
         except OSError:
             break
-
-        current = os.path.realpath(os.path.join(current, os.path.pardir))
+        if mode & stat.S_IXOTH == 0:
+            raise forms.ValidationError(
+                _("The path '%s' requires an execute permission bit.") % (
+                    current,
+                )
+            )
+        current = os.path.dirname(current)
         if current == '/':
             break
 
 
 def clean_path_locked(mp):
-    qs = Volume.objects.filter(vol_name=mp.replace('/mnt/', ''))
-    if qs.exists():
-        obj = qs[0]
-        if not obj.is_decrypted():
-            raise forms.ValidationError(
-                _("Volume %s is locked by encryption.") % (
-                    obj.vol_name,
-                )
+    obj = Volume.objects.filter(
+        vol_name=mp.replace('/mnt/', ''),
+    ).only('vol_name', 'vol_encrypt').first()
+    if obj and not obj.is_decrypted():
+        raise forms.ValidationError(
+            _("Volume %s is locked by encryption.") % (
+                obj.vol_name,
             )
+        )
+
+
+def _write_progress(progress):
+    """
+    Atomically replace the initial wizard progress file, readers never see
+    a partially written file
+    """
+    tmp = WIZARD_PROGRESSFILE + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(json.dumps(progress))
+    os.replace(tmp, WIZARD_PROGRESSFILE)
+
+
+def _disk_sort_key(choice):
+    """
+    Order (devname, label) choices by unit number, e.g. ada2 before ada10
+    """
+    return float(RE_DISK_SORT.sub(r'\1.\2', choice[0]))
+
+
+def _cached_unused_disks():
+    """
+    notifier().get_disks(unused=True) shared by the boot pool forms for a
+    few seconds, so re-rendering the attach/replace dialogs does not probe
+    every disk again.
+
+    This is the default per-process cache: dropping the key after an
+    attach or replace only clears it in the process that handled it, so
+    another worker may still offer that disk for UNUSED_DISKS_CACHE_TIMEOUT
+    seconds.
+    """
+    return cache.get_or_set(
+        UNUSED_DISKS_CACHE_KEY,
+        lambda: notifier().get_disks(unused=True),
+        UNUSED_DISKS_CACHE_TIMEOUT,
+    )
+
+
+def _unused_disk_choices():
+    """
+    Sorted (devname, "devname (size)") choices of the unused disks
+    """
+    # Grab partition list
+    # NOTE: This approach may fail if device nodes are not accessible.
+    disks = _cached_unused_disks()
+
+    return sorted((
+        (disk['devname'], "%s (%s)" % (
+            disk['devname'], humanize_number_si(int(disk['capacity'])),
+        ))
+        for disk in disks.values()
+    ), key=_disk_sort_key)
 
 
 class BootEnvAddForm(Form):
@@ -199,30 +256,9 @@ class BootEnvPoolAttachForm(Form):
         self.label = kwargs.pop('label')
         super(BootEnvPoolAttachForm, self).__init__(*args, **kwargs)
         self.fields['attach_disk'].choices = self._populate_disk_choices()
-        self.fields['attach_disk'].choices.sort(
-            key=lambda a: float(
-                re.sub(r'^.*?([0-9]+)[^0-9]*([0-9]*).*$', r'\1.\2', a[0])
-            )
-        )
 
     def _populate_disk_choices(self):
-
-        diskchoices = dict()
-
-        # Grab partition list
-        # NOTE: This approach may fail if device nodes are not accessible.
-        disks = notifier().get_disks(unused=True)
-
-        for disk in disks:
-            devname, capacity = disks[disk]['devname'], disks[disk]['capacity']
-            capacity = humanize_number_si(int(capacity))
-            diskchoices[devname] = "%s (%s)" % (devname, capacity)
-
-        choices = list(diskchoices.items())
-        choices.sort(key=lambda a: float(
-            re.sub(r'^.*?([0-9]+)[^0-9]*([0-9]*).*$', r'\1.\2', a[0])
-        ))
-        return choices
+        return _unused_disk_choices()
 
     def done(self):
         devname = self.cleaned_data['attach_disk']
@@ -233,6 +269,7 @@ class BootEnvPoolAttachForm(Form):
             except ClientException as e:
                 self._errors['__all__'] = self.error_class([str(e)])
                 return False
+        cache.delete(UNUSED_DISKS_CACHE_KEY)
         return True
 
 
@@ -247,30 +284,9 @@ class BootEnvPoolReplaceForm(Form):
         self.label = kwargs.pop('label')
         super(BootEnvPoolReplaceForm, self).__init__(*args, **kwargs)
         self.fields['replace_disk'].choices = self._populate_disk_choices()
-        self.fields['replace_disk'].choices.sort(
-            key=lambda a: float(
-                re.sub(r'^.*?([0-9]+)[^0-9]*([0-9]*).*$', r'\1.\2', a[0])
-            )
-        )
 
     def _populate_disk_choices(self):
-
-        diskchoices = dict()
-
-        # Grab partition list
-        # NOTE: This approach may fail if device nodes are not accessible.
-        disks = notifier().get_disks(unused=True)
-
-        for disk in disks:
-            devname, capacity = disks[disk]['devname'], disks[disk]['capacity']
-            capacity = humanize_number_si(int(capacity))
-            diskchoices[devname] = "%s (%s)" % (devname, capacity)
-
-        choices = list(diskchoices.items())
-        choices.sort(key=lambda a: float(
-            re.sub(r'^.*?([0-9]+)[^0-9]*([0-9]*).*$', r'\1.\2', a[0])
-        ))
-        return choices
+        return _unused_disk_choices()
 
     def done(self):
         devname = self.cleaned_data['replace_disk']
@@ -281,6 +297,7 @@ class BootEnvPoolReplaceForm(Form):
             except ClientException as e:
                 self._errors['__all__'] = self.error_class([str(e)])
                 return False
+        cache.delete(UNUSED_DISKS_CACHE_KEY)
         return True
 
 
@@ -288,16 +305,20 @@ class CommonWizard(SessionWizardView):
 
     template_done = 'system/done.html'
 
+    def dispatch(self, request, *args, **kwargs):
+        self._is_ajax = request.is_ajax()
+        return super(CommonWizard, self).dispatch(request, *args, **kwargs)
+
     def done(self, form_list, **kwargs):
         response = render_to_response(self.template_done, {
             'retval': getattr(self, 'retval', None),
         })
-        if not self.request.is_ajax():
-            response.content = (
-                b"<html><body><textarea>" +
-                response.content +
-                b"</textarea></boby></html>"
-            )
+        if not self._is_ajax:
+            response.content = b''.join((
+                TEXTAREA_PREFIX.encode(),
+                response.content,
+                TEXTAREA_SUFFIX.encode(),
+            ))
         return response
 
     def process_step(self, form):
@@ -319,12 +340,12 @@ class CommonWizard(SessionWizardView):
             context,
             **kwargs)
         # This is required for the workaround dojo.io.frame for file upload
-        if not self.request.is_ajax():
-            return HttpResponse(
-                "<html><body><textarea>" +
-                response.rendered_content +
-                "</textarea></boby></html>"
-            )
+        if not self._is_ajax:
+            return HttpResponse(''.join((
+                TEXTAREA_PREFIX,
+                response.rendered_content,
+                TEXTAREA_SUFFIX,
+            )))
         return response
 
 
@@ -360,8 +381,7 @@ class InitialWizard(CommonWizard):
             'percent': 0,
         }
 
-        with open(WIZARD_PROGRESSFILE, 'wb') as f:
-            f.write(pickle.dumps(progress))
+        _write_progress(progress)
 
         cleaned_data = self.get_all_cleaned_data()
         volume_name = cleaned_data.get('volume_name')
@@ -382,8 +402,7 @@ class InitialWizard(CommonWizard):
                 curstep += 1
                 progress['step'] = curstep
 
-                with open(WIZARD_PROGRESSFILE, 'wb') as f:
-                    f.write(pickle.dumps(progress))
+                _write_progress(progress)
 
                 if volume_import:
                     volume_name, guid = cleaned_data.get(
@@ -420,12 +439,10 @@ class InitialWizard(CommonWizard):
                     model_objs.append(volume)
 
                 # Create SMART tests for every disk available
-                disks = []
-                for o in SMARTTest.objects.all():
-                    for disk in o.smarttest_disks.all():
-                        if disk.pk not in disks:
-                            disks.append(disk.pk)
-                qs = Disk.objects.filter(disk_expiretime=None).exclude(pk__in=disks)
+                tested = SMARTTest.smarttest_disks.through.objects.values_list(
+                    'disk_id', flat=True,
+                )
+                qs = Disk.objects.filter(disk_expiretime=None).exclude(pk__in=tested)
 
                 if qs.exists():
                     smarttest = SMARTTest.objects.create(
@@ -437,76 +454,84 @@ class InitialWizard(CommonWizard):
                     model_objs.append(smarttest)
 
             else:
-                volume = Volume.objects.all()[0]
+                volume = Volume.objects.first()
                 volume_name = volume.vol_name
 
             curstep += 1
             progress['step'] = curstep
             progress['indeterminate'] = False
             progress['percent'] = 0
-            with open(WIZARD_PROGRESSFILE, 'wb') as f:
-                f.write(pickle.dumps(progress))
+            _write_progress(progress)
 
             services_restart = []
-            for i, share in enumerate(shares):
-                if not share:
-                    continue
-
-                share_name = share.get('share_name')
-                share_purpose = share.get('share_purpose')
-                share_allowguest = share.get('share_allowguest')
-                share_timemachine = share.get('share_timemachine')
-                share_iscsisize = share.get('share_iscsisize')
-                share_user = share.get('share_user')
-                share_usercreate = share.get('share_usercreate')
-                share_userpw = share.get('share_userpw')
-                share_group = share.get('share_group')
-                share_groupcreate = share.get('share_groupcreate')
-                share_mode = share.get('share_mode')
-
-                dataset_name = '%s/%s' % (volume_name, share_name)
-                if share_purpose != 'iscsitarget':
-                    try:
-                        with client as c:
+            # Look up existing names once instead of querying for every share
+            groups_by_name = {g.bsdgrp_group: g for g in bsdGroups.objects.all()}
+            usernames = set(
+                bsdUsers.objects.values_list('bsdusr_username', flat=True)
+            )
+            target_names = set(
+                iSCSITarget.objects.values_list('iscsi_target_name', flat=True)
+            )
+            portal = authini = mac = None
+            share_permissions = []
+            last_extent_id = 0
+            # Reuse a single middleware connection for all shares
+            with client as c:
+                for i, share in enumerate(shares):
+                    if not share:
+                        continue
+
+                    share_name = share.get('share_name')
+                    share_purpose = share.get('share_purpose')
+                    share_allowguest = share.get('share_allowguest')
+                    share_timemachine = share.get('share_timemachine')
+                    share_iscsisize = share.get('share_iscsisize')
+                    share_user = share.get('share_user')
+                    share_usercreate = share.get('share_usercreate')
+                    share_userpw = share.get('share_userpw')
+                    share_group = share.get('share_group')
+                    share_groupcreate = share.get('share_groupcreate')
+                    share_mode = share.get('share_mode')
+
+                    dataset_name = '%s/%s' % (volume_name, share_name)
+                    if share_purpose != 'iscsitarget':
+                        try:
                             c.call('pool.dataset.create', {
                                 'name': dataset_name,
                                 'type': 'FILESYSTEM',
                             })
-                    except ClientException as e:
-                        raise MiddlewareError(
-                            _('Failed to create ZFS dataset: %s.') % e
-                        )
-
-                    if share_purpose == 'afp':
-                        _n.change_dataset_share_type(dataset_name, 'mac')
-                    elif share_purpose == 'cifs':
-                        _n.change_dataset_share_type(dataset_name, 'windows')
-                    elif share_purpose == 'nfs':
-                        _n.change_dataset_share_type(dataset_name, 'unix')
+                        except ClientException as e:
+                            raise MiddlewareError(
+                                _('Failed to create ZFS dataset: %s.') % e
+                            )
+
+                        if share_purpose == 'afp':
+                            share_acl = 'mac'
+                        elif share_purpose == 'cifs':
+                            share_acl = 'windows'
+                        else:
+                            share_acl = 'unix'
+                        _n.change_dataset_share_type(dataset_name, share_acl)
 
-                    qs = bsdGroups.objects.filter(bsdgrp_group=share_group)
-                    if not qs.exists():
-                        if share_groupcreate:
-                            try:
-                                with client as c:
+                        group = groups_by_name.get(share_group)
+                        if group is None:
+                            if share_groupcreate:
+                                try:
                                     group = c.call('group.create', {
                                         'name': share_group,
                                     })
-                            except ValidationErrors as e:
-                                raise MiddlewareError(str(e))
+                                except ValidationErrors as e:
+                                    raise MiddlewareError(str(e))
+                                else:
+                                    group = bsdGroups.objects.get(pk=group)
+                                    groups_by_name[share_group] = group
+                                    model_objs.append(group)
                             else:
-                                group = bsdGroups.objects.get(pk=group)
-                                model_objs.append(group)
-                        else:
-                            group = bsdGroups.objects.all()[0]
-                    else:
-                        group = qs[0]
+                                group = bsdGroups.objects.first()
 
-                    qs = bsdUsers.objects.filter(bsdusr_username=share_user)
-                    if not qs.exists():
-                        if share_usercreate:
-                            try:
-                                with client as c:
+                        if share_user not in usernames:
+                            if share_usercreate:
+                                try:
                                     user = c.call('user.create', {
                                         'username': share_user,
                                         'full_name': share_user,
@@ -516,154 +541,159 @@ class InitialWizard(CommonWizard):
                                         'password_disabled': False if share_userpw else True,
                                         'group': group.id,
                                     })
-                            except ValidationErrors as e:
-                                raise MiddlewareError(str(e))
-                            else:
-                                user = bsdUsers.objects.get(pk=user)
-                                model_objs.append(user)
+                                except ValidationErrors as e:
+                                    raise MiddlewareError(str(e))
+                                else:
+                                    user = bsdUsers.objects.get(pk=user)
+                                    usernames.add(share_user)
+                                    model_objs.append(user)
+
+                        share_permissions.append({
+                            'path': '/mnt/%s' % dataset_name,
+                            'user': share_user,
+                            'group': share_group,
+                            'mode': share_mode,
+                            'recursive': False,
+                            'acl': share_acl,
+                        })
 
-                else:
-                    try:
-                        with client as c:
+                    else:
+                        try:
                             c.call('pool.dataset.create', {
                                 'name': dataset_name,
                                 'type': 'VOLUME',
                                 'sparse': True,
                                 'volsize': humansize_to_bytes(share_iscsisize),
                             })
-                    except ClientException as e:
-                        raise MiddlewareError(
-                            _('Failed to create ZFS volume: %s.') % e
+                        except ClientException as e:
+                            raise MiddlewareError(
+                                _('Failed to create ZFS volume: %s.') % e
+                            )
+
+                    path = '/mnt/%s/%s' % (volume_name, share_name)
+
+                    sharekwargs = {}
+
+                    if 'cifs' == share_purpose:
+                        if share_allowguest:
+                            sharekwargs['cifs_guestok'] = True
+                        model_objs.append(CIFS_Share.objects.create(
+                            cifs_name=share_name,
+                            cifs_path=path,
+                            **sharekwargs
+                        ))
+
+                    if 'afp' == share_purpose:
+                        if share_timemachine:
+                            sharekwargs['afp_timemachine'] = True
+                            sharekwargs['afp_timemachine_quota'] = 0
+                        model_objs.append(AFP_Share.objects.create(
+                            afp_name=share_name,
+                            afp_path=path,
+                            **sharekwargs
+                        ))
+
+                    if 'nfs' == share_purpose:
+                        nfs_share = NFS_Share.objects.create(
+                            nfs_comment=share_name,
                         )
+                        model_objs.append(NFS_Share_Path.objects.create(
+                            share=nfs_share,
+                            path=path,
+                        ))
 
-                path = '/mnt/%s/%s' % (volume_name, share_name)
-
-                sharekwargs = {}
-
-                if 'cifs' == share_purpose:
-                    if share_allowguest:
-                        sharekwargs['cifs_guestok'] = True
-                    model_objs.append(CIFS_Share.objects.create(
-                        cifs_name=share_name,
-                        cifs_path=path,
-                        **sharekwargs
-                    ))
-
-                if 'afp' == share_purpose:
-                    if share_timemachine:
-                        sharekwargs['afp_timemachine'] = True
-                        sharekwargs['afp_timemachine_quota'] = 0
-                    model_objs.append(AFP_Share.objects.create(
-                        afp_name=share_name,
-                        afp_path=path,
-                        **sharekwargs
-                    ))
-
-                if 'nfs' == share_purpose:
-                    nfs_share = NFS_Share.objects.create(
-                        nfs_comment=share_name,
-                    )
-                    model_objs.append(NFS_Share_Path.objects.create(
-                        share=nfs_share,
-                        path=path,
-                    ))
+                    if 'iscsitarget' == share_purpose:
+
+                        # Shared by all iSCSI shares, set up on the first one
+                        if portal is None:
+                            portal = iSCSITargetPortal.objects.first()
+                            if portal is None:
+                                portal = iSCSITargetPortal.objects.create()
+                                model_objs.append(portal)
+                                model_objs.append(iSCSITargetPortalIP.objects.create(
+                                    iscsi_target_portalip_portal=portal,
+                                    iscsi_target_portalip_ip='0.0.0.0',
+                                ))
+
+                            authini = iSCSITargetAuthorizedInitiator.objects.first()
+                            if authini is None:
+                                authini = (
+                                    iSCSITargetAuthorizedInitiator.objects.create()
+                                )
+                                model_objs.append(authini)
 
-                if 'iscsitarget' == share_purpose:
+                            try:
+                                nic = list(choices.NICChoices(
+                                    nolagg=True, novlan=True, exclude_configured=False)
+                                )[0][0]
+                                mac = c.call(
+                                    'interface.query', [('name', '=', nic)], {'get': True},
+                                )['state']['link_address'].replace(':', '')
+                                last_extent_id = iSCSITargetExtent.objects.order_by(
+                                    '-id'
+                                ).values_list('id', flat=True).first() or 0
+                            except Exception:
+                                mac = None
+
+                        if mac is None:
+                            serial = "10000001"
+                        else:
+                            serial = mac + "%.2d" % last_extent_id
 
-                    qs = iSCSITargetPortal.objects.all()
-                    if qs.exists():
-                        portal = qs[0]
-                    else:
-                        portal = iSCSITargetPortal.objects.create()
-                        model_objs.append(portal)
-                        model_objs.append(iSCSITargetPortalIP.objects.create(
-                            iscsi_target_portalip_portal=portal,
-                            iscsi_target_portalip_ip='0.0.0.0',
-                        ))
+                        iscsi_target_name = '%sTarget' % share_name
+                        iscsi_target_name_idx = 1
+                        while iscsi_target_name in target_names:
+                            iscsi_target_name = '%sTarget%d' % (share_name, iscsi_target_name_idx)
+                            iscsi_target_name_idx += 1
+                        target_names.add(iscsi_target_name)
 
-                    qs = iSCSITargetAuthorizedInitiator.objects.all()
-                    if qs.exists():
-                        authini = qs[0]
-                    else:
-                        authini = (
-                            iSCSITargetAuthorizedInitiator.objects.create()
+                        target = iSCSITarget.objects.create(
+                            iscsi_target_name=iscsi_target_name
                         )
-                        model_objs.append(authini)
-                    try:
-                        nic = list(choices.NICChoices(
-                            nolagg=True, novlan=True, exclude_configured=False)
-                        )[0][0]
-                        mac = subprocess.Popen(
-                            "ifconfig %s ether| grep ether | "
-                            "awk '{print $2}'|tr -d :" % (nic, ),
-                            shell=True,
-                            stdout=subprocess.PIPE,
-                            encoding='utf8',
-                        ).communicate()[0]
-                        ltg = iSCSITargetExtent.objects.order_by('-id')
-                        if ltg.count() > 0:
-                            lid = ltg[0].id
-                        else:
-                            lid = 0
-                        serial = mac.strip() + "%.2d" % lid
-                    except Exception:
-                        serial = "10000001"
-
-                    iscsi_target_name = '%sTarget' % share_name
-                    iscsi_target_name_idx = 1
-                    while iSCSITarget.objects.filter(iscsi_target_name=iscsi_target_name).exists():
-                        iscsi_target_name = '%sTarget%d' % (share_name, iscsi_target_name_idx)
-                        iscsi_target_name_idx += 1
-
-                    target = iSCSITarget.objects.create(
-                        iscsi_target_name=iscsi_target_name
-                    )
-                    model_objs.append(target)
+                        model_objs.append(target)
 
-                    model_objs.append(iSCSITargetGroups.objects.create(
-                        iscsi_target=target,
-                        iscsi_target_portalgroup=portal,
-                        iscsi_target_initiatorgroup=authini,
-                    ))
+                        model_objs.append(iSCSITargetGroups.objects.create(
+                            iscsi_target=target,
+                            iscsi_target_portalgroup=portal,
+                            iscsi_target_initiatorgroup=authini,
+                        ))
 
-                    iscsi_target_extent_path = 'zvol/%s/%s' % (
-                        volume_name,
-                        share_name,
-                    )
+                        iscsi_target_extent_path = 'zvol/%s/%s' % (
+                            volume_name,
+                            share_name,
+                        )
 
-                    extent = iSCSITargetExtent.objects.create(
-                        iscsi_target_extent_name='%sExtent' % share_name,
-                        iscsi_target_extent_type='ZVOL',
-                        iscsi_target_extent_path=iscsi_target_extent_path,
-                        iscsi_target_extent_serial=serial,
-                    )
-                    model_objs.append(extent)
-                    with client as c:
+                        extent = iSCSITargetExtent.objects.create(
+                            iscsi_target_extent_name='%sExtent' % share_name,
+                            iscsi_target_extent_type='ZVOL',
+                            iscsi_target_extent_path=iscsi_target_extent_path,
+                            iscsi_target_extent_serial=serial,
+                        )
+                        model_objs.append(extent)
+                        last_extent_id = extent.id
                         target_to_extent = c.call(
                             'iscsi.targetextent.create', {
                                 'target': target.id,
                                 'extent': extent.id
                             }
                         )
-                    model_objs.append(iSCSITargetToExtent.objects.get(pk=target_to_extent['id']))
+                        model_objs.append(iSCSITargetToExtent.objects.get(pk=target_to_extent['id']))
 
-                if share_purpose not in services_restart:
-                    services.objects.filter(srv_service=share_purpose).update(
-                        srv_enable=True
-                    )
-                    services_restart.append(share_purpose)
+                    if share_purpose not in services_restart:
+                        services.objects.filter(srv_service=share_purpose).update(
+                            srv_enable=True
+                        )
+                        services_restart.append(share_purpose)
 
-                progress['percent'] = int(
-                    (float(i + 1) / float(len(shares))) * 100
-                )
-                with open(WIZARD_PROGRESSFILE, 'wb') as f:
-                    f.write(pickle.dumps(progress))
+                    progress['percent'] = int(
+                        (float(i + 1) / float(len(shares))) * 100
+                    )
+                    _write_progress(progress)
 
             console = cleaned_data.get('sys_console')
-            adv = models.Advanced.objects.order_by('-id')[0]
-            advdata = dict(adv.__dict__)
+            adv = models.Advanced.objects.order_by('-id').first()
+            advdata = model_to_dict(adv)
             advdata['adv_consolemsg'] = console
-            advdata.pop('_state', None)
             advform = AdvancedForm(
                 advdata,
                 instance=adv,
@@ -678,17 +708,17 @@ class InitialWizard(CommonWizard):
                     bsdusr_email=cleaned_data.get('sys_email'),
                 )
 
-            email = models.Email.objects.order_by('-id')[0]
+            email = models.Email.objects.order_by('-id').first()
             em = EmailForm(cleaned_data, instance=email)
             if em.is_valid():
                 em.save()
 
-            try:
-                settingsm = models.Settings.objects.order_by('-id')[0]
-            except IndexError:
-                settingsm = models.Settings.objects.create()
+            settingsm = (
+                models.Settings.objects.order_by('-id').first() or
+                models.Settings.objects.create()
+            )
 
-            settingsdata = settingsm.__dict__
+            settingsdata = model_to_dict(settingsm)
             settingsdata.update({
                 'stg_language': cleaned_data.get('stg_language'),
                 'stg_kbdmap': cleaned_data.get('stg_kbdmap'),
@@ -706,11 +736,19 @@ class InitialWizard(CommonWizard):
                     settingsform._errors,
                 )
         except Exception:
+            # Undo in reverse creation order with one delete per model, the
+            # volume is created first so it is still the last to go
+            volumes = []
+            pks_by_model = OrderedDict()
             for obj in reversed(model_objs):
                 if isinstance(obj, Volume):
-                    obj.delete(destroy=False, cascade=False)
+                    volumes.append(obj)
                 else:
-                    obj.delete()
+                    pks_by_model.setdefault(type(obj), []).append(obj.pk)
+            for model, pks in pks_by_model.items():
+                model.objects.filter(pk__in=pks).delete()
+            for volume in volumes:
+                volume.delete(destroy=False, cascade=False)
             raise
 
         if ds_form:
@@ -719,15 +757,14 @@ class InitialWizard(CommonWizard):
             progress['step'] = curstep
             progress['indeterminate'] = True
 
-            with open(WIZARD_PROGRESSFILE, 'wb') as f:
-                f.write(pickle.dumps(progress))
+            _write_progress(progress)
 
             if cleaned_data.get('ds_type') == 'ad':
-                try:
-                    ad = ActiveDirectory.objects.all().order_by('-id')[0]
-                except Exception:
-                    ad = ActiveDirectory.objects.create()
-                addata = ad.__dict__
+                ad = (
+                    ActiveDirectory.objects.order_by('-id').first() or
+                    ActiveDirectory.objects.create()
+                )
+                addata = model_to_dict(ad)
                 addata.update({
                     'ad_domainname': cleaned_data.get('ds_ad_domainname'),
                     'ad_bindname': cleaned_data.get('ds_ad_bindname'),
@@ -746,11 +783,11 @@ class InitialWizard(CommonWizard):
                         adform._errors,
                     )
             elif cleaned_data.get('ds_type') == 'ldap':
-                try:
-                    ldap = LDAP.objects.all().order_by('-id')[0]
-                except Exception:
-                    ldap = LDAP.objects.create()
-                ldapdata = ldap.__dict__
+                ldap = (
+                    LDAP.objects.order_by('-id').first() or
+                    LDAP.objects.create()
+                )
+                ldapdata = model_to_dict(ldap)
                 ldapdata.update({
                     'ldap_hostname': cleaned_data.get('ds_ldap_hostname'),
                     'ldap_basedn': cleaned_data.get('ds_ldap_basedn'),
@@ -770,11 +807,11 @@ class InitialWizard(CommonWizard):
                         ldapform._errors,
                     )
             elif cleaned_data.get('ds_type') == 'nis':
-                try:
-                    nis = NIS.objects.all().order_by('-id')[0]
-                except Exception:
-                    nis = NIS.objects.create()
-                nisdata = nis.__dict__
+                nis = (
+                    NIS.objects.order_by('-id').first() or
+                    NIS.objects.create()
+                )
+                nisdata = model_to_dict(nis)
                 nisdata.update({
                     'nis_domain': cleaned_data.get('ds_nis_domain'),
                     'nis_servers': cleaned_data.get('ds_nis_servers'),
@@ -796,41 +833,14 @@ class InitialWizard(CommonWizard):
 
         # Change permission after joining directory service
         # since users/groups may not be local
-        for i, share in enumerate(shares):
-            if not share:
-                continue
-
-            share_name = share.get('share_name')
-            share_purpose = share.get('share_purpose')
-            share_user = share.get('share_user')
-            share_group = share.get('share_group')
-            share_mode = share.get('share_mode')
-
-            if share_purpose == 'iscsitarget':
-                continue
-
-            if share_purpose == 'afp':
-                share_acl = 'mac'
-            elif share_purpose == 'cifs':
-                share_acl = 'windows'
-            else:
-                share_acl = 'unix'
-
-            _n.mp_change_permission(
-                path='/mnt/%s/%s' % (volume_name, share_name),
-                user=share_user,
-                group=share_group,
-                mode=share_mode,
-                recursive=False,
-                acl=share_acl,
-            )
+        for permission in share_permissions:
+            _n.mp_change_permission(**permission)
 
         curstep += 1
         progress['step'] = curstep
         progress['indeterminate'] = False
         progress['percent'] = 1
-        with open(WIZARD_PROGRESSFILE, 'wb') as f:
-            f.write(pickle.dumps(progress))
+        _write_progress(progress)
 
         # This must be outside transaction block to make sure the changes
         # are committed before the call of ix-fstab
@@ -838,16 +848,14 @@ class InitialWizard(CommonWizard):
         _n.reload("disk")  # Reloads collectd as well
 
         progress['percent'] = 50
-        with open(WIZARD_PROGRESSFILE, 'wb') as f:
-            f.write(pickle.dumps(progress))
+        _write_progress(progress)
 
         _n.start("ix-system")
         _n.restart("system_datasets")  # FIXME: may reload collectd again
         _n.reload("timeservices")
 
         progress['percent'] = 70
-        with open(WIZARD_PROGRESSFILE, 'wb') as f:
-            f.write(pickle.dumps(progress))
+        _write_progress(progress)
 
         _n.restart("cron")
         _n.reload("user")
@@ -860,8 +868,7 @@ class InitialWizard(CommonWizard):
         ))
 
         progress['percent'] = 100
-        with open(WIZARD_PROGRESSFILE, 'wb') as f:
-            f.write(pickle.dumps(progress))
+        _write_progress(progress)
 
         os.unlink(WIZARD_PROGRESSFILE)
 
@@ -961,7 +968,7 @@ class ManualUpdateWizard(FileWizard):
                 with client as c:
                     uuid = c.call('update.manual', path)
                 self.request.session['allow_reboot'] = True
-            return HttpResponse(content=f'<html><body><textarea>{uuid}</textarea></boby></html>', status=202)
+            return HttpResponse(content=f'{TEXTAREA_PREFIX}{uuid}{TEXTAREA_SUFFIX}', status=202)
         except Exception:
             try:
                 self.file_storage.delete(updatefile.name)
@@ -26,7 +26,6 @@
 from collections import OrderedDict, namedtuple
 from datetime import date
 import base64
-import pickle as pickle
 import errno
 import json
 import logging
@@ -1070,17 +1069,12 @@ def manualupdate_progress(request):
 
 
 def initialwizard_progress(request):
-    data = {}
+    # Already JSON, written atomically by InitialWizard.done
     try:
-        with open(forms.WIZARD_PROGRESSFILE, 'rb') as f:
-            data = f.read()
-        try:
-            data = pickle.loads(data)
-        except Exception:
-            data = {}
+        with open(forms.WIZARD_PROGRESSFILE, 'r') as f:
+            content = f.read()
     except FileNotFoundError:
-        data = {}
-    content = json.dumps(data)
+        content = '{}'
     return HttpResponse(content, content_type='application/json')
 
 
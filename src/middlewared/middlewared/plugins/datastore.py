@@ -15,7 +15,7 @@ if not apps.ready:
     django.setup()
 
 from django.apps import apps
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models import Q
 from django.db.models.fields.related import ForeignKey, ManyToManyField
 
@@ -329,6 +329,29 @@ class DatastoreService(Service):
             cursor.close()
         return rv
 
+    @accepts(List('queries'))
+    def sql_batch(self, queries):
+        """
+        Execute a list of `[query, params]` in order, all or none of them.
+
+        Used by the HA database backend to replicate several queries to
+        the standby node within a single call. A failed batch is journaled
+        as a whole, so it must not leave part of it applied.
+        """
+        cursor = connection.cursor()
+        try:
+            with transaction.atomic():
+                for query, params in queries:
+                    if params is None:
+                        cursor.executelocal(query)
+                    else:
+                        cursor.executelocal(query, params)
+        except OperationalError as err:
+            raise CallError(err)
+        finally:
+            cursor.close()
+        return True
+
     @accepts(List('queries'))
     def restore(self, queries):
         """